@@ -1,6 +1,9 @@
 from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, NameObject
+from PyPDF2.pdf import PageObject
 from pathfinder.chronicle.pdf import TransparentPDF
-from pathfinder.chronicle.cells import get_cells_for_season
+from pathfinder.chronicle.cells import SeasonCells, get_season_cells
+import io
 from io import BytesIO
 import types
 from datetime import date
@@ -9,6 +12,9 @@ import csv
 import requests
 from dataclasses import dataclass
 
+# Matches the four digit season and scenario number in a scenario PDF title such as PZOPFS0901E
+SCENARIO_NUMBER = re.compile(r'(\d\d)(\d\d)')
+
 
 @dataclass
 class PlayerDetails:
@@ -35,14 +41,49 @@ class PlayerDetails:
 
 def parse_reporting_sheet(sheet_export_url):
     """
-    Build a list of PlayerDetails objects from the specified sheet URL. This URL must point to the exportable CSV of
-    the export sheet within the reporting doc.
+    Generate PlayerDetails objects from the specified sheet URL. This URL must point to the exportable CSV of
+    the export sheet within the reporting doc. Rows are parsed as they arrive rather than reading the whole response
+    into memory first, so this is a generator and can only be consumed once.
+    """
+    with requests.get(sheet_export_url, stream=True) as response:
+        # Read through a text wrapper rather than iter_lines, which yields a spurious empty line whenever a chunk
+        # boundary falls between the \r and \n of the CRLF line endings in the export. The csv module expects to
+        # handle line endings itself, hence newline=''
+        response.raw.decode_content = True
+        reader = csv.reader(io.TextIOWrapper(response.raw, encoding='utf-8', newline=''), delimiter=',')
+        # Skip header row
+        next(reader, None)
+        for row in reader:
+            if row:
+                yield PlayerDetails(*row)
+
+
+# Measured string widths, keyed on (font file, family, style, size in points, unit scale, text). The font file is empty
+# for core fonts and distinguishes TTF fonts registered under the same family name from different files, and the unit
+# scale is needed as widths are returned in the PDF's user units
+_WIDTH_CACHE = {}
+_WIDTH_CACHE_SIZE = 4096
+
+
+def _string_width(pdf: TransparentPDF, text: str):
+    """
+    Get the width of a string in the pdf's current font, memoized across sheets as the same few strings (dates, event
+    names, GM numbers and the like) are measured for every player.
+
+    :param pdf:
+        The TransparentPDF with the font to measure already set
+    :param text:
+        The string to measure
+    :return:
+        The width of the string in user units
     """
-    response = requests.get(sheet_export_url)
-    reader = csv.reader(response.content.decode('utf-8').splitlines(), delimiter=',')
-    # Skip header row
-    reader.__next__()
-    return list([PlayerDetails(*row) for row in reader])
+    key = (pdf.current_font.get('ttffile', ''), pdf.font_family, pdf.font_style, pdf.font_size_pt, pdf.k, text)
+    width = _WIDTH_CACHE.get(key)
+    if width is None:
+        if len(_WIDTH_CACHE) >= _WIDTH_CACHE_SIZE:
+            _WIDTH_CACHE.clear()
+        width = _WIDTH_CACHE[key] = pdf.get_string_width(text)
+    return width
 
 
 class ChronicleSheet:
@@ -51,10 +92,21 @@ class ChronicleSheet:
     """
 
     def __init__(self, cells, pdf: TransparentPDF):
-        self.cells = cells
+        """
+        :param cells:
+            Either a dict of cell name to (x, y, width, height, centred?) or a SeasonCells wrapping one
+        :param pdf:
+            TransparentPDF to draw into
+        """
+        if not isinstance(cells, SeasonCells):
+            cells = SeasonCells.from_cells(cells)
+        self.season_cells = cells
+        self.cells = cells.cells
         self.pdf = pdf
         self.default_font = 'Arial'
         self.default_style = ''
+        # Last (font, style) passed to set_font, along with the family and style FPDF normalised them to
+        self._last_font = None
 
     def strike_out(self, cellname: str):
         """
@@ -63,53 +115,80 @@ class ChronicleSheet:
         :param cellname:
             Cell name within this sheet
         """
+        self.strike_out_many([cellname])
+
+    def strike_out_many(self, cellnames):
+        """
+        Cross out each of the given cells which exist, setting up the alpha and line width once for all of them
+
+        :param cellnames:
+            Iterable of cell names within this sheet
+        """
         offset = 1
-        if cellname in self.cells:
+        cells = [cell for cell in map(self.cells.get, cellnames) if cell is not None]
+        if cells:
             self.pdf.set_alpha(1.0)
-            x, y, width, height, centred_text = self.cells[cellname]
             self.pdf.set_line_width(1)
-            self.pdf.line(x + offset, y + offset, x + width - offset, y + height - offset)
-            self.pdf.line(x + width - offset, y + offset, x + offset, y + height - offset)
+            for x, y, width, height, centred_text in cells:
+                self.pdf.line(x + offset, y + offset, x + width - offset, y + height - offset)
+                self.pdf.line(x + width - offset, y + offset, x + offset, y + height - offset)
 
     def text(self, cellname, contents, centred=None, font=None, style=None):
         if font is None:
             font = self.default_font
         if style is None:
             style = self.default_style
-        if cellname in self.cells and contents is not None:
+        cell = self.cells.get(cellname)
+        if cell is not None and contents is not None:
             if isinstance(contents, date):
                 contents = contents.strftime('%d %b %Y')
-            x, y, width, height, centre_text = self.cells[cellname]
-            base_font_size = 14 * height / 7
             contents = str(contents)
-            self.pdf.set_font(font, style=style, size=base_font_size)
+            if not contents.strip():
+                # Nothing to see, skip selecting and measuring the font
+                return
+            x, y, width, height, centre_text = cell
+            base_font_size = 14 * height / 7
+            self._set_font(font, style, base_font_size)
             self.pdf.set_line_width(0)
             if str.endswith(contents, '.5'):
                 if str.startswith(contents, '0'):
                     contents = u"\u00BD"
                 else:
                     contents = contents[:-2] + u"\u00BD"
-            text_width = self.pdf.get_string_width(contents)
+            text_width = _string_width(self.pdf, contents)
             if text_width > (width - 1):
                 self.pdf.set_font_size(base_font_size * ((width - 1) / text_width))
-                text_width = self.pdf.get_string_width(contents)
+                text_width = _string_width(self.pdf, contents)
             if centred is None:
                 centred = centre_text
             offset = (width - (text_width + 1)) / 2 if centred else 0.5
             self.pdf.text(x + offset, y + height - 1.6, contents)
 
+    def _set_font(self, font, style, size):
+        """
+        Select a font, only changing the size if the font and style are the ones selected by the previous call and
+        nothing else has changed them on the PDF since
+        """
+        if self._last_font == (font, style, self.pdf.font_family, self.pdf.font_style):
+            self.pdf.set_font_size(size)
+        else:
+            self.pdf.set_font(font, style=style, size=size)
+            self._last_font = (font, style, self.pdf.font_family, self.pdf.font_style)
+
     def texts(self, **kwargs):
         for cell, contents in kwargs.items():
             self.text(cellname=cell, contents=contents)
 
     def image(self, cellname, image_filename):
-        if cellname in self.cells:
-            x, y, width, height, centre_text = self.cells[cellname]
+        cell = self.cells.get(cellname)
+        if cell is not None:
+            x, y, width, height, centre_text = cell
             self.pdf.image(image_filename, x, y, 0, height)
 
     def rect(self, cellname):
-        if cellname in self.cells:
-            x, y, width, height, centred_text = self.cells[cellname]
+        cell = self.cells.get(cellname)
+        if cell is not None:
+            x, y, width, height, centred_text = cell
             self.pdf.rect(x, y, width, height, style='F')
 
 
@@ -183,11 +262,8 @@ def tier(tier: int, slow=False):
     """
 
     def annotate(sheet: ChronicleSheet):
-        tier_cellnames = [name for name in sheet.cells if str.startswith(name, 'subtier')]
-        if f'subtier_{tier}_slow' in tier_cellnames:
-            tier_cellnames.remove(f'subtier_{tier}_{"slow" if slow else "fast"}')
-        for tier_cellname in tier_cellnames:
-            sheet.strike_out(tier_cellname)
+        keep = f'subtier_{tier}_{"slow" if slow else "fast"}' if f'subtier_{tier}_slow' in sheet.cells else None
+        sheet.strike_out_many(name for name in sheet.season_cells.subtier_names if name != keep)
 
     return annotate
 
@@ -248,14 +324,27 @@ def gm(signature_filename: str, initials_filename: str, gm_number: int):
 
     def annotate(sheet: ChronicleSheet):
         sheet.image('gm_sig', signature_filename)
-        for cellname in sheet.cells:
-            if str.endswith(cellname, 'initials'):
-                sheet.image(cellname, initials_filename)
+        for cellname in sheet.season_cells.initials_names:
+            sheet.image(cellname, initials_filename)
         sheet.text('gm_number', gm_number)
 
     return annotate
 
 
+# Gold from a day job check, one entry for each band of five, so 5 or less is 1gp, 6-10 is 5gp and so on
+_DAY_JOB_GOLD = (1, 5, 10, 20, 50, 75, 100, 150)
+
+
+def gold_for_day_job(r: int):
+    """
+    Gold earned from a day job check
+
+    :param r:
+        The result of the check, anything over 35 earns the maximum
+    """
+    return _DAY_JOB_GOLD[max(0, min((r - 1) // 5, len(_DAY_JOB_GOLD) - 1))]
+
+
 def gold_and_day_job(gp_gained: int, roll: str):
     """
     Fill in day job from roll, and gold gained, ignoring everything else
@@ -267,25 +356,6 @@ def gold_and_day_job(gp_gained: int, roll: str):
     :return:
     """
 
-    def gold_for_day_job(r: int):
-        if r <= 5:
-            return 1
-        if r <= 10:
-            return 5
-        if r <= 15:
-            return 10
-        if r <= 20:
-            return 20
-        if r <= 25:
-            return 50
-        if r <= 30:
-            return 75
-        if r <= 35:
-            return 100
-        if r <= 40:
-            return 150
-        return 150
-
     def annotate(sheet: ChronicleSheet):
         sheet.texts(gp_gained=gp_gained)
         if roll is not None:
@@ -318,10 +388,12 @@ def gold(gp_gained: int, starting_gp=None, day_job=0, gp_spent=0, items_sold=0):
 
     def annotate(sheet: ChronicleSheet):
         sheet.texts(starting_gp=starting_gp, gp_gained=gp_gained)
-        if day_job is not 0:
+        # Collect up cells to cross out and do them all at the end
+        strike_outs = []
+        if day_job != 0:
             sheet.text('day_job', day_job)
         else:
-            sheet.strike_out('day_job')
+            strike_outs.append('day_job')
         # Some sheets have items sold / items bought, some just have 'gold spent'
         if 'items_sold' not in sheet.cells:
             inner_gp_spent = gp_spent - items_sold
@@ -329,16 +401,17 @@ def gold(gp_gained: int, starting_gp=None, day_job=0, gp_spent=0, items_sold=0):
         else:
             inner_gp_spent = gp_spent
             inner_items_sold = items_sold
-        if inner_gp_spent is not 0:
+        if inner_gp_spent != 0:
             sheet.text('gp_spent', inner_gp_spent)
         else:
-            sheet.strike_out('gp_spent')
-        if inner_items_sold is not 0:
+            strike_outs.append('gp_spent')
+        if inner_items_sold != 0:
             sheet.text('items_sold', inner_items_sold)
         else:
-            sheet.strike_out('items_sold')
+            strike_outs.append('items_sold')
         sheet.text('gp_subtotal', starting_gp + gp_gained + day_job + items_sold)
         sheet.text('gp_total', starting_gp + gp_gained + day_job - gp_spent + items_sold)
+        sheet.strike_out_many(strike_outs)
 
     return annotate
 
@@ -384,7 +457,7 @@ def prestige(prestige_gained, initial_prestige=None, initial_fame=None, prestige
                         prestige_gained=prestige_gained,
                         current_fame=initial_fame + prestige_gained,
                         current_prestige=initial_prestige + prestige_gained - prestige_spent)
-            if prestige_spent is not 0:
+            if prestige_spent != 0:
                 sheet.texts(prestige_spent=prestige_spent)
             else:
                 sheet.strike_out('prestige_spent')
@@ -406,7 +479,7 @@ def chronicle_info(input_filename: str):
             title = input_pdf.getDocumentInfo()['/Title']
         except KeyError:
             title = 'Unknown'
-        m = re.search(r'(\d\d)(\d\d)', title)
+        m = SCENARIO_NUMBER.search(title)
         if m:
             season = int(m.groups()[0])
             scenario = int(m.groups()[1])
@@ -414,52 +487,150 @@ def chronicle_info(input_filename: str):
         return title, '?', '?'
 
 
-def annotate_chronicle_sheet(input_filename: str, output_filename: str, season: int = 0, page_number: int = 0,
-                             annotation_functions=None):
+@dataclass
+class ChronicleTemplate:
+    """
+    The chronicle sheet page from a scenario PDF, along with its size and the cells to use for it. Reading this in is
+    the expensive part of producing a sheet, so read it once with read_chronicle_template and then pass it to
+    annotate_chronicle_sheet for each player.
+    """
+    page: PageObject
+    width: float
+    height: float
+    season: int
+    cells: SeasonCells
+
+
+def read_chronicle_template(input_filename: str, season: int = 0, page_number: int = 0) -> ChronicleTemplate:
+    """
+    Read the chronicle sheet page from a scenario PDF
+
+    :param input_filename:
+        Scenario PDF to read
+    :param season:
+        Season, used to pick the cell layout. Defaults to 0 to detect it from the PDF title
+    :param page_number:
+        Page number of the chronicle sheet, starting at 1. Defaults to 0 to use the last page in the PDF
+    :return:
+        A ChronicleTemplate
+    """
     # Scale points to mm by multiplying by..
     pt_to_mm = 0.35277777777778
-    # Read the input PDF
+    # Read the whole input PDF into memory, the pages refer back to the reader's stream so it has to stay open for as
+    # long as the template is in use
     with open(input_filename, mode='rb') as input_file:
-        input = PdfFileReader(input_file)
-        # Work around a library bug, sometimes it thinks things are encrypted when they're not
-        if input.isEncrypted:
-            input.decrypt('')
+        input = PdfFileReader(BytesIO(input_file.read()))
+    # Work around a library bug, sometimes it thinks things are encrypted when they're not
+    if input.isEncrypted:
+        input.decrypt('')
+
+    if page_number == 0:
+        # No page number specified, use the last page in the PDF
+        page_number = input.getNumPages()
+    page = input.getPage(page_number - 1)
+    # Try to find the scenario number, and therefore the season to use
+    if season == 0:
+        print(input.getDocumentInfo())
+        title = input.getDocumentInfo()['/Title']
+        m = SCENARIO_NUMBER.search(title)
+        if m:
+            season = int(m.groups()[0])
 
-        if page_number is 0:
-            # No page number specified, use the last page in the PDF
-            page_number = input.getNumPages()
-        page = input.getPage(page_number - 1)
-        # Try to find the scenario number, and therefore the season to use
-        if season is 0:
-            print(input.getDocumentInfo())
-            title = input.getDocumentInfo()['/Title']
-            m = re.search(r'(\d\d)(\d\d)', title)
-            if m:
-                season = int(m.groups()[0])
-
-        # Create a blank FPDF document of the correct size with a single page
-        width, height = page.mediaBox.upperRight  # Sizes in points, i.e. 1/72 inch units
-        overlay_pdf = TransparentPDF(orientation='P', unit='mm',
-                                     format=(float(width) * pt_to_mm, float(height) * pt_to_mm))
-        overlay_pdf.add_page()
-        # Write any annotations to the overlay
-        if annotation_functions is None:
-            annotation_functions = []
-        if type(annotation_functions) == types.FunctionType:
-            annotation_functions = [annotation_functions]
-        # Pick up the right cell dict based on the season and create a new ChronicleSheet to annotate
-        sheet = ChronicleSheet(cells=get_cells_for_season(season), pdf=overlay_pdf)
-        for annotation_function in annotation_functions:
-            # Run each of the annotation functions in turn to add content
-            annotation_function(sheet)
-        # Merge from the overlay onto the original page
-        with BytesIO(overlay_pdf.output(dest='S').encode('latin-1')) as stream:
-
-            overlay_pdf2 = PdfFileReader(stream, strict=False)
-            merge = overlay_pdf2.getPage(0)
-            page.mergePage(merge)
-            # Write the output PDF
-            with open(output_filename, mode='wb') as output_file:
-                writer = PdfFileWriter()
-                writer.addPage(page)
-                writer.write(output_file)
+    width, height = page.mediaBox.upperRight  # Sizes in points, i.e. 1/72 inch units
+    # Pick up the right cell dict based on the season
+    return ChronicleTemplate(page=page, width=float(width) * pt_to_mm, height=float(height) * pt_to_mm,
+                             season=season, cells=get_season_cells(season))
+
+
+def _stamp_page(page: PageObject, overlay_page: PageObject, name='/PFToolsOverlay'):
+    """
+    Draw one page over the top of another. PyPDF2's mergePage does this by parsing and rewriting the content of both
+    pages, which for a detailed chronicle sheet is by far the slowest part of creating it. Instead, the overlay is
+    turned into a form XObject with its own resources and drawn after the page's existing content, which is left
+    exactly as it is, so no content needs to be parsed and there's no chance of resource names clashing.
+
+    :param page:
+        The page to draw onto, modified in place by replacing its /Contents and /Resources entries
+    :param overlay_page:
+        The page to draw over it
+    :param name:
+        Name to use for the form XObject in the page's resources
+    """
+    form = DecodedStreamObject()
+    form.setData(overlay_page['/Contents'].getObject().getData())
+    form.update({NameObject('/Type'): NameObject('/XObject'),
+                 NameObject('/Subtype'): NameObject('/Form'),
+                 NameObject('/BBox'): overlay_page.mediaBox,
+                 NameObject('/Resources'): overlay_page['/Resources'].getObject()})
+    # Copy rather than modify the resource dicts, they may be shared with other pages
+    resources = DictionaryObject(page['/Resources'].getObject())
+    xobjects = DictionaryObject(resources.get('/XObject', DictionaryObject()).getObject())
+    xobjects[NameObject(name)] = form
+    resources[NameObject('/XObject')] = xobjects
+    page[NameObject('/Resources')] = resources
+    # Save the graphics state before the existing content and restore it afterwards, so nothing the page does to the
+    # state affects the overlay, then draw the overlay
+    # A page with no content, such as a blank page, has no /Contents entry at all
+    contents = page.get('/Contents')
+    if contents is None:
+        existing_content = []
+    elif isinstance(contents.getObject(), ArrayObject):
+        existing_content = contents.getObject()
+    else:
+        existing_content = [contents]
+    save_state, draw_overlay = DecodedStreamObject(), DecodedStreamObject()
+    save_state.setData(b'q\n')
+    draw_overlay.setData(f'\nQ q {name} Do Q\n'.encode('latin-1'))
+    page[NameObject('/Contents')] = ArrayObject([save_state, *existing_content, draw_overlay])
+
+
+def annotate_chronicle_sheet(input_filename: str, output_filename: str, season: int = 0, page_number: int = 0,
+                             annotation_functions=None, template: ChronicleTemplate = None):
+    """
+    Write a copy of the chronicle sheet from a scenario PDF with annotations added
+
+    :param input_filename:
+        Scenario PDF to read, ignored if a template is supplied
+    :param output_filename:
+        PDF file to write
+    :param season:
+        Season, ignored if a template is supplied. Defaults to 0 to detect it from the PDF title
+    :param page_number:
+        Page number of the chronicle sheet, ignored if a template is supplied. Defaults to 0 for the last page
+    :param annotation_functions:
+        A single annotation function, or a list of them, each of which is called in turn with the ChronicleSheet
+    :param template:
+        A ChronicleTemplate from read_chronicle_template. When creating several sheets from the same scenario, read
+        this once and pass it in for each sheet rather than reading and parsing the scenario PDF every time
+    """
+    if template is None:
+        template = read_chronicle_template(input_filename, season=season, page_number=page_number)
+    # Stamping modifies the page it stamps onto, so work on a shallow copy to leave the template's page untouched. It
+    # replaces entries in the page dict rather than changing the objects they refer to.
+    page = PageObject(template.page.pdf, template.page.indirectRef)
+    page.update(template.page)
+
+    # Create a blank FPDF document of the correct size with a single page
+    overlay_pdf = TransparentPDF(orientation='P', unit='mm', format=(template.width, template.height))
+    overlay_pdf.add_page()
+    # Write any annotations to the overlay
+    if annotation_functions is None:
+        annotation_functions = []
+    if type(annotation_functions) == types.FunctionType:
+        annotation_functions = [annotation_functions]
+    # Create a new ChronicleSheet to annotate
+    sheet = ChronicleSheet(cells=template.cells, pdf=overlay_pdf)
+    for annotation_function in annotation_functions:
+        # Run each of the annotation functions in turn to add content
+        annotation_function(sheet)
+    # Merge from the overlay onto the original page
+    with BytesIO(overlay_pdf.output(dest='S').encode('latin-1')) as stream:
+
+        overlay_pdf2 = PdfFileReader(stream, strict=False)
+        merge = overlay_pdf2.getPage(0)
+        _stamp_page(page, merge)
+        # Write the output PDF
+        with open(output_filename, mode='wb') as output_file:
+            writer = PdfFileWriter()
+            writer.addPage(page)
+            writer.write(output_file)
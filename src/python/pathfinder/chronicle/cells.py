@@ -1,3 +1,32 @@
+from dataclasses import dataclass
+from functools import lru_cache
+
+
+@dataclass(frozen=True)
+class SeasonCells:
+    """
+    A cell dict along with the groups of cell names the annotation functions look for, worked out once rather than
+    by scanning the whole dict for every player's sheet
+    """
+    cells: dict
+    subtier_names: tuple
+    initials_names: tuple
+
+    @staticmethod
+    def from_cells(cells: dict) -> 'SeasonCells':
+        return SeasonCells(cells=cells,
+                           subtier_names=tuple(name for name in cells if name.startswith('subtier')),
+                           initials_names=tuple(name for name in cells if name.endswith('initials')))
+
+
+@lru_cache(maxsize=None)
+def get_season_cells(season: int) -> SeasonCells:
+    """
+    Get the cells for a season along with the cell name groupings, cached as the cell dicts never change
+    """
+    return SeasonCells.from_cells(get_cells_for_season(season))
+
+
 # Dict of cell name to (x, y, width, height, centred?) for seasons 3, 4
 def get_cells_for_season(season: int):
     if season in [20]:
@@ -1,5 +1,6 @@
 import logging
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 import os
 from os.path import abspath
 from pathlib import Path
@@ -20,6 +21,55 @@ parser.add_argument('output_dir', nargs='?', type=str,
 parser.add_argument('-s', '--season', type=int, help='Explicitly set the season, normally we can auto-detect this',
                     default=0)
 parser.add_argument('-t', '--title', type=str, help='Set the title, otherwise pulled from chronicle metadata', default=None)
+parser.add_argument('-j', '--jobs', type=int, help='number of sheets to create in parallel, defaults to %(default)s',
+                    default=os.cpu_count() or 1)
+
+# Chronicle template in each worker process, read once by _init_worker as PDF pages can't be sent between processes
+_template = None
+
+
+def _init_worker(input_filename, season):
+    global _template
+    _template = read_chronicle_template(input_filename, season=season)
+
+
+def create_sheet(p: PlayerDetails, input_filename, output_filename, template=None):
+    """
+    Create the chronicle sheet for a single player
+
+    :param p:
+        PlayerDetails from the reporting sheet
+    :param input_filename:
+        Scenario PDF
+    :param output_filename:
+        Filename to write the annotated sheet to
+    :param template:
+        ChronicleTemplate read from the scenario PDF, defaults to None to use the one read by this worker process
+    """
+    logging.info(f'Creating sheet for {p.player_name} - {p.character_name}')
+    # Non-specified day-job rolls are strings and can't be parsed as ints
+    if p.dayjob_roll == '':
+        dayjob = None
+    else:
+        dayjob = p.dayjob_roll
+    annotate_chronicle_sheet(
+        input_filename=input_filename,
+        output_filename=output_filename,
+        template=template or _template,
+        annotation_functions=[
+            # show_cells(),
+            player(player_name=p.player_name, character_name=p.character_name,
+                   player_number=p.pfs_number, character_number=p.character_number, faction=p.faction),
+            tier(tier=p.tier, slow=(p.slow == 'Y')),
+            xp(xp_gained=p.xp),
+            prestige(prestige_gained=p.prestige),
+            gold_and_day_job(gp_gained=p.gold, roll=dayjob),
+            event(event_name=p.event_name,
+                  event_code=p.event_code, game_date=p.date),
+            gm(signature_filename=f'{conf.dir}/signature.png',
+               initials_filename=f'{conf.dir}/initials.png',
+               gm_number=p.gm_number),
+            notes(top=p.notes)])
 
 
 def main():
@@ -38,28 +88,16 @@ def main():
         file_prefix = options.title
     else:
         file_prefix = f'{scenario_season}-{scenario_number}'
-    for p in parse_reporting_sheet(sheet_export_url=conf.sheets_url):
-        logging.info(f'Creating sheet for {p.player_name} - {p.character_name}')
-        # Non-specified day-job rolls are strings and can't be parsed as ints
-        if p.dayjob_roll == '':
-            dayjob = None
-        else:
-            dayjob = p.dayjob_roll
-        annotate_chronicle_sheet(
-            input_filename=input_filename,
-            output_filename=f'{output_dir}/{file_prefix} {p.player_name}.pdf',
-            season=season,
-            annotation_functions=[
-                # show_cells(),
-                player(player_name=p.player_name, character_name=p.character_name,
-                       player_number=p.pfs_number, character_number=p.character_number, faction=p.faction),
-                tier(tier=p.tier, slow=(p.slow == 'Y')),
-                xp(xp_gained=p.xp),
-                prestige(prestige_gained=p.prestige),
-                gold_and_day_job(gp_gained=p.gold, roll=dayjob),
-                event(event_name=p.event_name,
-                      event_code=p.event_code, game_date=p.date),
-                gm(signature_filename=f'{conf.dir}/signature.png',
-                   initials_filename=f'{conf.dir}/initials.png',
-                   gm_number=p.gm_number),
-                notes(top=p.notes)])
+    players = list(parse_reporting_sheet(sheet_export_url=conf.sheets_url))
+    output_filenames = [f'{output_dir}/{file_prefix} {p.player_name}.pdf' for p in players]
+    workers = min(options.jobs, len(players))
+    if workers > 1:
+        # Each worker reads the chronicle sheet in once and reuses it for every player it's given
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(input_filename, season)) as executor:
+            list(executor.map(create_sheet, players, [input_filename] * len(players), output_filenames))
+    else:
+        # Read the chronicle sheet in once and reuse it for every player
+        template = read_chronicle_template(input_filename, season=season)
+        for p, output_filename in zip(players, output_filenames):
+            create_sheet(p, input_filename, output_filename, template=template)
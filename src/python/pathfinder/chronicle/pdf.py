@@ -1,5 +1,16 @@
+import os
+
 from fpdf import FPDF
 
+# Font and font file entries added by add_font, keyed on its arguments. Loading a TTF font means either parsing the
+# font file or unpickling its cached metrics, and generating sheets for a table adds the same fonts to a new PDF for
+# every player, so only do this once per process and copy the entries into each PDF after that
+_FONT_CACHE = {}
+
+# Parsed images, keyed on filename and modification time. The GM signature and initials go on every player's sheet,
+# so parse them once per process rather than once per PDF
+_IMAGE_CACHE = {}
+
 
 class TransparentPDF(FPDF):
     """
@@ -10,6 +21,54 @@ class TransparentPDF(FPDF):
         super(TransparentPDF, self).__init__(orientation=orientation, unit=unit, format=format)
         self.extgstates = {}
 
+    def add_font(self, family, style='', fname='', uni=False):
+        """
+        Add a TrueType font, as FPDF.add_font, reusing the metrics loaded by any earlier call with the same arguments
+        """
+        key = (family, style, fname, uni)
+        if key not in _FONT_CACHE:
+            fonts_before, font_files_before = set(self.fonts), set(self.font_files)
+            super().add_font(family, style=style, fname=fname, uni=uni)
+            fonts = {fontkey: font for fontkey, font in self.fonts.items() if fontkey not in fonts_before}
+            if not fonts:
+                # Font was already in this PDF, nothing to cache
+                return
+            font_files = {name: font_file for name, font_file in self.font_files.items()
+                          if name not in font_files_before}
+            # Snapshot the entries before anything is written, FPDF adds to the subset and object numbers later
+            _FONT_CACHE[key] = ({fontkey: TransparentPDF._copy_font(font) for fontkey, font in fonts.items()},
+                                {name: dict(font_file) for name, font_file in font_files.items()})
+            return
+        fonts, font_files = _FONT_CACHE[key]
+        for fontkey, font in fonts.items():
+            if fontkey not in self.fonts:
+                self.fonts[fontkey] = TransparentPDF._copy_font(font, i=len(self.fonts) + 1)
+        for name, font_file in font_files.items():
+            self.font_files.setdefault(name, dict(font_file))
+
+    @staticmethod
+    def _copy_font(font, **kwargs):
+        # Character widths are only ever read so can be shared, the subset is appended to as text is written
+        font = dict(font, **kwargs)
+        if 'subset' in font:
+            font['subset'] = list(font['subset'])
+        return font
+
+    def _parsepng(self, name):
+        return TransparentPDF._cached_image(name, super()._parsepng)
+
+    def _parsejpg(self, name):
+        return TransparentPDF._cached_image(name, super()._parsejpg)
+
+    @staticmethod
+    def _cached_image(name, parse):
+        key = (name, os.path.getmtime(name))
+        if key not in _IMAGE_CACHE:
+            _IMAGE_CACHE[key] = parse(name)
+        # FPDF adds the object number to the info dict and removes the data once it's been written, so each PDF needs
+        # its own copy, the image data itself is shared
+        return dict(_IMAGE_CACHE[key])
+
     def set_alpha(self, alpha, bm='Normal'):
         """
         Set the current transparency used for drawing operations
@@ -27,11 +86,21 @@ class TransparentPDF(FPDF):
         self.set_fill_color(red, green, blue)
 
     def add_ext_gstate(self, parms):
+        """
+        Register a graphics state, returning the number of an existing state with the same parameters if there is one.
+        Annotating a sheet sets the alpha many times over with the same handful of values, so without this every call
+        would add another ExtGState object and resource dictionary entry to the PDF.
+
+        :param parms:
+            Dict of graphics state parameters, 'ca', 'CA' and 'BM'
+        :return:
+            The number of the graphics state, used as /GSn
+        """
+        for n, state in self.extgstates.items():
+            if state['parms'] == parms:
+                return n
         n = len(self.extgstates.keys()) + 1
-        if n not in self.extgstates.keys():
-            self.extgstates[n] = {'parms': parms}
-        else:
-            self.extgstates[n]['parms'] = parms
+        self.extgstates[n] = {'parms': parms}
         return n
 
     def _set_ext_gstate(self, gs):
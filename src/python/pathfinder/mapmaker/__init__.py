@@ -2,18 +2,24 @@ import io
 import logging
 import math
 import re
-import tempfile
+import struct
+import zlib
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum
-from os.path import dirname, basename, abspath
+from functools import lru_cache
+from itertools import product
+from os.path import dirname, basename, abspath, isabs, join, getmtime
 from pathlib import Path
 from typing import Literal
 
 import PyPDF2 as pdf
+import numpy as np
 from PIL import Image, ImageEnhance
 from PyPDF2.generic import IndirectObject
 from fpdf import FPDF
-from guizero import App, Picture
 
 
 class ImageGrid:
@@ -32,7 +38,8 @@ class ImageGrid:
         :param image_filename:
             The filename of an image to crop
         """
-        self.clicks = []
+        # Only the last three clicks are ever used
+        self.clicks = deque(maxlen=3)
         self.path = Path(image_filename)
         self.im = Image.open(image_filename)
         self.output_path = output_path if output_path is not None else self.path.parent
@@ -44,7 +51,6 @@ class ImageGrid:
 
         def handler(event):
             self.clicks.append((event.x, event.y))
-            self.clicks = self.clicks[-3:]
             if len(self.clicks) == 3:
                 self.trim()
                 event.widget.master.destroy()
@@ -70,15 +76,17 @@ class ImageGrid:
         # between the first and third click points
         refined_grid_size_estimate = (abs(tx - bx) / squares_x + abs(ty - by) / squares_y) / 2
 
-        # Crop the top and left
-        top_margin_crop = ty % refined_grid_size_estimate
-        left_margin_crop = tx % refined_grid_size_estimate
-        self.im = self.im.crop((left_margin_crop, top_margin_crop, self.im.width, self.im.height))
+        # Crop the top and left, rounding to whole pixels as crop would
+        top = round(ty % refined_grid_size_estimate)
+        left = round(tx % refined_grid_size_estimate)
 
-        # Crop the bottom and right
-        right_margin_crop = self.im.width % refined_grid_size_estimate
-        bottom_margin_crop = self.im.height % refined_grid_size_estimate
-        self.im = self.im.crop((0, 0, self.im.width - right_margin_crop, self.im.height - bottom_margin_crop))
+        # Then crop the bottom and right to whole squares from there, all in a single crop rather than building an
+        # intermediate image with just the top and left removed
+        width = self.im.width - left
+        height = self.im.height - top
+        right = left + round(width - width % refined_grid_size_estimate)
+        bottom = top + round(height - height % refined_grid_size_estimate)
+        self.im = self.im.crop((left, top, right, bottom))
 
         # Calculate resultant number of squares in final, cropped, image
         squares_x = round(self.im.width / refined_grid_size_estimate)
@@ -90,11 +98,116 @@ class ImageGrid:
         logging.info(f'Saving image to {output_path}')
         self.im.save(fp=output_path)
 
+    def find_grid(self, min_grid_size=10):
+        """
+        Find the grid in the image without any clicks. Grid lines are edges repeated at a fixed spacing, so sum the
+        edge strength along each column and row and look for the spacing at which these profiles best match shifted
+        copies of themselves. This works well for maps with a clear, regular grid, but has nothing to go on if the
+        grid is faint or missing, so the result should be checked.
+
+        :param min_grid_size:
+            Smallest grid size in pixels to consider, smaller shifts always match well because neighbouring pixels
+            are similar
+        :return:
+            A tuple of (grid size, left, top), where grid size is in pixels and may be fractional, and left and top
+            are the position of the first grid line on each axis
+        :raise:
+            ValueError if the image is too small or no grid could be found
+        """
+        grey = np.asarray(self.im.convert('L'), dtype=np.float32)
+        # Blur the profiles slightly, otherwise a line at a fractional spacing lands on different pixels from one
+        # square to the next and the match at the grid size is split between the two nearest whole pixel shifts
+        kernel = np.array([1, 2, 3, 2, 1], dtype=np.float64) / 9
+        profile_x = np.convolve(np.abs(np.diff(grey, axis=1)).sum(axis=0, dtype=np.float64), kernel, mode='same')
+        profile_y = np.convolve(np.abs(np.diff(grey, axis=0)).sum(axis=1, dtype=np.float64), kernel, mode='same')
+        max_lag = min(len(profile_x), len(profile_y)) // 2
+        if max_lag <= min_grid_size + 1:
+            raise ValueError(f'Image {self.path.name} is too small to find a grid')
+        score = ImageGrid._autocorrelation(profile_x, max_lag) + ImageGrid._autocorrelation(profile_y, max_lag)
+
+        # Any multiple of the grid size matches nearly as well as the grid size itself, so of the local peaks take the
+        # smallest one which is close to the best
+        lags = np.arange(min_grid_size, max_lag)
+        peaks = lags[(score[lags] > score[lags - 1]) & (score[lags] >= score[lags + 1])]
+        if len(peaks) == 0:
+            raise ValueError(f'Unable to find a grid in {self.path.name}')
+        grid_size = int(peaks[score[peaks] >= 0.8 * score[peaks].max()][0])
+
+        # Grid sizes are rarely a whole number of pixels, so refine the estimate from the furthest multiple of it we
+        # can see, which divides any error in locating the peak by that multiple
+        multiple = max(1, (max_lag - 1) // grid_size)
+        window = max(1, grid_size // 4)
+        start = max(1, multiple * grid_size - window)
+        end = min(max_lag - 1, multiple * grid_size + window)
+        peak = start + int(np.argmax(score[start:end + 1]))
+        grid_size = float(ImageGrid._interpolate_peak(score, peak)) / multiple
+
+        return grid_size, ImageGrid._grid_offset(profile_x, grid_size), ImageGrid._grid_offset(profile_y, grid_size)
+
+    @staticmethod
+    def _autocorrelation(profile, max_lag):
+        # Normalised autocorrelation for lags 0 to max_lag inclusive, via FFT as the profiles can be thousands long
+        values = profile - profile.mean()
+        n = len(values)
+        spectrum = np.fft.rfft(values, 2 * n)
+        correlation = np.fft.irfft(spectrum * np.conj(spectrum))[:max_lag + 1]
+        # Longer shifts have fewer overlapping values, scale so they aren't penalised for that
+        correlation /= n - np.arange(max_lag + 1)
+        return correlation / correlation[0] if correlation[0] > 0 else correlation
+
+    @staticmethod
+    def _interpolate_peak(values, i):
+        # Fit a parabola through a peak and its neighbours to locate it to within a fraction of a pixel
+        if i <= 0 or i >= len(values) - 1:
+            return float(i)
+        before, at, after = values[i - 1], values[i], values[i + 1]
+        denominator = before - 2 * at + after
+        return i + (0.5 * (before - after) / denominator if denominator != 0 else 0.0)
+
+    @staticmethod
+    def _grid_offset(profile, grid_size):
+        # Position of the first grid line. Treat each position as an angle around a circle one grid square round, the
+        # edge strength weighted average of these angles is then the phase of the grid lines. Value i in the profile
+        # is the edge between pixels i and i + 1
+        angles = (np.arange(len(profile)) + 0.5) * (2 * math.pi / grid_size)
+        phase = math.atan2(float(np.dot(profile, np.sin(angles))), float(np.dot(profile, np.cos(angles))))
+        offset = (phase * grid_size / (2 * math.pi)) % grid_size
+        # A line just before the start of the image is better treated as being at the start than a whole square in
+        return 0.0 if offset > grid_size - 1 else offset
+
+    def auto_trim(self):
+        """
+        Find the grid with find_grid, then trim and save the image as if the equivalent three clicks had been made
+        """
+        grid_size, left, top = self.find_grid()
+        squares_x = int((self.im.width - 1 - left) // grid_size)
+        squares_y = int((self.im.height - 1 - top) // grid_size)
+        if squares_x < 1 or squares_y < 1:
+            raise ValueError(f'Grid found in {self.path.name} is larger than the image')
+        logging.info(f'Found grid in {self.path.name}, size {grid_size:.2f} pixels, offset ({left:.1f}, {top:.1f})')
+        self.clicks.extend([(left, top), (left + grid_size, top + grid_size),
+                            (left + squares_x * grid_size, top + squares_y * grid_size)])
+        self.trim()
+
+    @staticmethod
+    def auto_crop(image_name, output_dir=None):
+        """
+        Load an image, find its grid and crop to it without showing the GUI
+
+        :param image_name:
+            The filename of an image to crop
+        :param output_dir:
+            Directory to write the cropped image to, defaults to the directory containing the image
+        """
+        ImageGrid(image_name, output_dir).auto_trim()
+
     @staticmethod
     def show_and_crop(image_name, output_dir=None):
         """
         Load an image, create the very simple GUI, crop when we have three clicks, then return
         """
+        # Imported here so the rest of this module can be used without loading the GUI toolkit
+        from guizero import App, Picture
         logging.info('Pick three points - top left, top left + 1 square diagonally, then bottom right')
         grid = ImageGrid(image_name, output_dir)
         app = App(title=f'Grid Finder - {image_name}', width=grid.im.width, height=grid.im.height, layout='auto')
@@ -105,6 +218,10 @@ class ImageGrid:
         app.display()
 
 
+# Matches names in the form foo_bar_12.4x25.3.png, extracting the name, 12.4, and 25.3 bits
+MAP_FILENAME = re.compile(r'(^[\w-]+?)_*(\d+(?:\.\d*)?|\.\d+)x(\d+(?:\.\d*)?|\.\d+)\.png$')
+
+
 def parse_filename(filename):
     """
     Parse a filename of the form name_WWxHH.png, i.e. deep_canyon_10x18.png, into a set of useful properties. Returns
@@ -118,16 +235,21 @@ def parse_filename(filename):
     :raise:
         ValueError if the string can't be parsed in this format
     """
-    filename = abspath(filename)
+    if not isabs(filename):
+        filename = abspath(filename)
+    return _parse_absolute_filename(filename)
+
+
+# Only ever called with absolute paths, a relative one would resolve differently if the working directory changed
+@lru_cache(maxsize=1024)
+def _parse_absolute_filename(filename):
     leaf_name = basename(filename)
-    # Match in the form foo_bar_12.4x25.3.png and extract the name, 12.4, and 25.3 bits
-    m = re.match(r'(^[\w-]+?)_*(\d+(?:\.\d*)?|\.\d+)x(\d+(?:\.\d*)?|\.\d+)\.png$',
-                 leaf_name)
+    m = MAP_FILENAME.match(leaf_name)
     if m:
         name = m.groups()[0]
         width = float(m.groups()[1])
         height = float(m.groups()[2])
-        pdf_name = dirname(filename) + '/' + name + '.pdf'
+        pdf_name = join(dirname(filename), name + '.pdf')
         return filename, pdf_name, name, width, height
     else:
         raise ValueError('Filename not of the form name_WxH.png, was {}'.format(leaf_name))
@@ -174,7 +296,10 @@ class Paper(Enum):
 
 def basic_image_ops(image, brighten=1.0, sharpen=None, saturation=None):
     """
-    Perform basic brighten, sharpen, colour operations on an image
+    Perform basic brighten, sharpen, colour operations on an image. The results are equivalent to applying PIL's
+    ImageEnhance Brightness, Sharpness and Color in that order. When sharpening an RGB image, which is the slowest of
+    the three, all the operations are applied in a single pass over the pixel data rather than building a new full
+    size image for each. Without sharpening, the colour change is applied as a colour matrix.
 
     :param image:
         Image to process
@@ -185,20 +310,148 @@ def basic_image_ops(image, brighten=1.0, sharpen=None, saturation=None):
     :param saturation:
         Saturation, defaults to None for no operation
     :return:
-        The modified image
+        The modified image, or the original image if none of the operations would have any effect
     """
+    # A factor of exactly 1.0 is the identity for all three enhancers, treat it as None rather than building an
+    # identical copy of the image
     if brighten is not None and brighten != 1.0:
         logging.info('Applying brighten {}'.format(brighten))
-        image = ImageEnhance.Brightness(image).enhance(brighten)
-    if sharpen is not None:
+    else:
+        brighten = None
+    if sharpen is not None and sharpen != 1.0:
         logging.info('Applying sharpen {}'.format(sharpen))
+    else:
+        sharpen = None
+    if saturation is not None and saturation != 1.0:
+        logging.info('Applying saturation {}'.format(saturation))
+    else:
+        saturation = None
+    if brighten is None and sharpen is None and saturation is None:
+        return image
+    if image.mode == 'RGB' and sharpen is not None:
+        return _enhance_rgb(image, brighten, sharpen, saturation)
+    if image.mode == 'RGB' and saturation is not None:
+        # Saturation blends each pixel with its luma, so it's a colour matrix that convert can apply in a single pass,
+        # much more quickly than ImageEnhance. Darkening can be folded into the same matrix, brightening has to be done
+        # first as PIL clips the brightened values before the saturation is applied.
+        matrix = saturation * np.identity(3) + (1 - saturation) * _LUMA
+        if brighten is not None and brighten > 1.0:
+            image = _brighten(image, brighten)
+        elif brighten is not None:
+            matrix *= brighten
+        return image.convert('RGB', np.hstack([matrix, np.zeros((3, 1))]).ravel().tolist())
+    # PIL's enhancers are quicker on their own for brightening alone, and handle modes other than plain RGB
+    if brighten is not None:
+        image = _brighten(image, brighten)
+    if sharpen is not None:
         image = ImageEnhance.Sharpness(image).enhance(sharpen)
     if saturation is not None:
-        logging.info('Applying saturation {}'.format(saturation))
         image = ImageEnhance.Color(image).enhance(saturation)
     return image
 
 
+def _brighten(image, brighten):
+    """
+    Equivalent to ImageEnhance.Brightness, but as a lookup table applied by Image.point for the common modes. Brightness
+    scales every colour value by the same factor, so there are only 256 possible results which can be worked out up
+    front rather than multiplying every pixel. The table is built in single precision and truncated, as PIL's blend
+    does, so results are identical.
+
+    :param image:
+        Image to brighten
+    :param brighten:
+        Brightness factor
+    :return:
+        The brightened image
+    """
+    if image.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        return ImageEnhance.Brightness(image).enhance(brighten)
+    table = np.minimum(255, (np.float32(brighten) * np.arange(256, dtype=np.float32)).astype(np.int64)).tolist()
+    colours = 1 if image.mode[0] == 'L' else 3
+    # Alpha is left alone, as it is by ImageEnhance
+    return image.point(table * colours + (list(range(256)) if 'A' in image.mode else []))
+
+
+# Weights used by PIL when converting RGB to greyscale, ITU-R 601-2 luma
+_LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def _enhance_rgb(image, brighten=None, sharpen=None, saturation=None, strip_height=64):
+    """
+    Apply brighten, sharpen and saturation to an RGB image in one pass. The image is processed in horizontal strips so
+    the floating point working copy stays small and in cache, each strip goes through all three operations before the
+    next is read, rather than converting the whole image at once and building a new full size image per operation.
+
+    :param image:
+        RGB image to process
+    :param brighten:
+        Brightness factor, or None to skip
+    :param sharpen:
+        Sharpness factor, or None to skip
+    :param saturation:
+        Colour factor, or None to skip
+    :param strip_height:
+        Number of rows to process at a time
+    :return:
+        A new RGB image
+    """
+    src = np.asarray(image)
+    height, width, _ = src.shape
+    out = np.empty_like(src)
+
+    # Sharpening needs one row of context above and below each strip
+    context = 1 if sharpen is not None and width > 2 else 0
+    if context:
+        # ImageEnhance.Sharpness blends with ImageFilter.SMOOTH, a 3x3 kernel of ones with a centre weight of 5 and a
+        # divisor of 13. Expanding the blend gives a weight for the 3x3 box sum and an extra weight for the centre.
+        box_weight = (1 - sharpen) / 13
+        centre_weight = (1 - sharpen) * 4 / 13 + sharpen
+    if saturation is not None:
+        # Saturation blends each pixel with its luma, which is a single 3x3 colour matrix
+        saturation_matrix = (saturation * np.identity(3, dtype=np.float32) + (1 - saturation) * _LUMA).T
+
+    # Scratch buffers are allocated once at the largest strip size and reused for every strip, each strip then works
+    # on views of these rather than allocating new arrays for every intermediate result
+    work_buffer = np.empty((min(height, strip_height + 2 * context), width, 3), dtype=np.float32)
+    if context:
+        rows_buffer = np.empty((len(work_buffer), width, 3), dtype=np.float32)
+        box_buffer = np.empty((len(work_buffer), width - 2, 3), dtype=np.float32)
+        centre_buffer = np.empty_like(box_buffer)
+    if saturation is not None:
+        saturation_buffer = np.empty((min(height, strip_height), width, 3), dtype=np.float32)
+
+    for top in range(0, height, strip_height):
+        bottom = min(height, top + strip_height)
+        context_top = max(0, top - context)
+        context_bottom = min(height, bottom + context)
+        work = work_buffer[:context_bottom - context_top]
+        np.copyto(work, src[context_top:context_bottom])
+        if brighten is not None:
+            work *= brighten
+            np.clip(work, 0, 255, out=work)
+        if context and len(work) > 2:
+            # As with PIL the outermost pixels of the image are left alone
+            rows = rows_buffer[:len(work) - 2]
+            np.add(work[:-2], work[1:-1], out=rows)
+            rows += work[2:]
+            box = box_buffer[:len(rows)]
+            np.add(rows[:, :-2], rows[:, 1:-1], out=box)
+            box += rows[:, 2:]
+            box *= box_weight
+            centre = centre_buffer[:len(rows)]
+            np.multiply(work[1:-1, 1:-1], centre_weight, out=centre)
+            box += centre
+            np.clip(box, 0, 255, out=box)
+            work[1:-1, 1:-1] = box
+        strip = work[top - context_top:bottom - context_top]
+        if saturation is not None:
+            strip = np.matmul(strip, saturation_matrix, out=saturation_buffer[:len(strip)])
+        strip += 0.5
+        np.clip(strip, 0, 255, out=strip)
+        np.copyto(out[top:bottom], strip, casting='unsafe')
+    return Image.fromarray(out, mode='RGB')
+
+
 def process_image_with_border(im: Image, squares_wide: float, squares_high: float, border_north=5, border_east=5,
                               border_west=5, border_south=5, brighten=None, sharpen=None, saturation=None):
     """
@@ -251,7 +504,140 @@ def process_image_with_border(im: Image, squares_wide: float, squares_high: floa
     }
 
 
-def make_single_page_pdf(image_spec: {}, pdf_filename: str):
+class MapPDF(FPDF):
+    """
+    FPDF which can add PIL images directly, without writing them out to files first, and with a quicker PNG reader.
+    FPDF 1.7 builds up PNG data by appending one chunk at a time, which takes time proportional to the square of the
+    file size, and splits out alpha channels with a regular expression per row, both of which are very slow for the
+    large images produced from maps. This reads the same information in a single pass, falling back to FPDF's own
+    reader for any kinds of PNG not produced by the map tools.
+    """
+
+    def add_image(self, image: Image, x, y, w=0, h=0, jpeg_quality=None):
+        """
+        Put a PIL image on the current page, as FPDF's image but without going through a file
+
+        :param image:
+            The image to add
+        :param x:
+            Left edge of the image on the page
+        :param y:
+            Top edge of the image on the page
+        :param w:
+            Width of the image on the page, 0 to work it out from the height
+        :param h:
+            Height of the image on the page, 0 to work it out from the width
+        :param jpeg_quality:
+            JPEG quality from 1 to 95 to embed images without transparency as JPEGs, or None to always use lossless
+            compression
+        """
+        self.add_image_info(MapPDF.image_info(image, jpeg_quality), x, y, w, h)
+
+    def add_image_info(self, info, x, y, w=0, h=0):
+        """
+        Put an image on the current page from the info returned by image_info, see add_image
+        """
+        if 'smask' in info and self.pdf_version < '1.4':
+            self.pdf_version = '1.4'
+        # FPDF looks images up by name, register this one under a name of its own and then place it as usual
+        name = f'image-{len(self.images) + 1}'
+        info['i'] = len(self.images) + 1
+        self.images[name] = info
+        self.image(name, x, y, w, h)
+
+    @staticmethod
+    def image_info(image: Image, jpeg_quality=None):
+        """
+        Encode a PIL image into the form FPDF embeds in the PDF. This is the expensive part of adding an image, and
+        doesn't touch the PDF, so can be run for several images at once on different threads.
+
+        :param image:
+            The image to encode
+        :param jpeg_quality:
+            JPEG quality, or None for lossless, see add_image
+        :return:
+            A dict of image info for add_image_info
+        """
+        if image.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+        width, height = image.size
+        if jpeg_quality is not None and 'A' not in image.mode:
+            # JPEG data goes into the PDF exactly as it is, so the pixels are only encoded once
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=jpeg_quality)
+            info = {'w': width, 'h': height, 'cs': 'DeviceGray' if image.mode == 'L' else 'DeviceRGB', 'bpc': 8,
+                    'f': 'DCTDecode', 'data': buffer.getvalue()}
+        elif 'A' in image.mode:
+            info = MapPDF._alpha_info(image)
+        else:
+            # PNG's filtering compresses map images much better than deflate alone, and the PDF can use the
+            # compressed data exactly as it is
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG')
+            info = MapPDF._opaque_info(image, buffer.getvalue())
+        return info
+
+    @staticmethod
+    def _base_info(image: Image):
+        width, height = image.size
+        colours = 1 if image.mode[0] == 'L' else 3
+        return {'w': width, 'h': height, 'cs': 'DeviceGray' if colours == 1 else 'DeviceRGB', 'bpc': 8,
+                'f': 'FlateDecode', 'dp': f'/Predictor 15 /Colors {colours} /BitsPerComponent 8 /Columns {width}',
+                'pal': '', 'trns': ''}
+
+    @staticmethod
+    def _alpha_info(image: Image):
+        # Colour and alpha have to go into the PDF as separate images, decode and split them here, writing each row
+        # with a leading zero byte to mark it as unfiltered for the PNG predictor
+        info = MapPDF._base_info(image)
+        width, height = image.size
+        colours = 1 if image.mode[0] == 'L' else 3
+        pixels = np.asarray(image)
+
+        def compress_rows(channels):
+            rows = np.zeros((height, 1 + width * channels.shape[2]), dtype=np.uint8)
+            rows[:, 1:] = channels.reshape(height, -1)
+            return zlib.compress(rows.tobytes())
+
+        info['data'] = compress_rows(pixels[:, :, :colours])
+        info['smask'] = compress_rows(pixels[:, :, colours:])
+        return info
+
+    @staticmethod
+    def _opaque_info(image: Image, png: bytes):
+        # Opaque images can be used as they are, the PDF just needs all the compressed data from the IDAT chunks
+        info = MapPDF._base_info(image)
+        idat = []
+        pos = 8
+        while pos < len(png):
+            length, chunk_type = struct.unpack('>I4s', png[pos:pos + 8])
+            if chunk_type == b'IDAT':
+                idat.append(png[pos + 8:pos + 8 + length])
+            elif chunk_type == b'IEND':
+                break
+            pos += length + 12
+        info['data'] = b''.join(idat)
+        return info
+
+    def _parsepng(self, name):
+        with Image.open(name) as image:
+            if image.mode not in ('L', 'LA', 'RGB', 'RGBA') or image.info.get('interlace') or \
+                    'transparency' in image.info:
+                return super()._parsepng(name)
+            if 'A' in image.mode:
+                if self.pdf_version < '1.4':
+                    self.pdf_version = '1.4'
+                return MapPDF._alpha_info(image)
+            with open(name, 'rb') as f:
+                png = f.read()
+            # The IDAT data is used as it is, which is only right for 8 bits per sample. Pillow reports 16 bit RGB as
+            # RGB and 1, 2 and 4 bit greyscale as L, so check the bit depth in the IHDR chunk
+            if png[24] != 8:
+                return super()._parsepng(name)
+            return MapPDF._opaque_info(image, png)
+
+
+def make_single_page_pdf(image_spec: {}, pdf_filename: str, jpeg_quality=None):
     """
     Take the processed image from process_image_with_border and produce a PDF file with those exact dimensions and a
     single page.
@@ -260,17 +646,50 @@ def make_single_page_pdf(image_spec: {}, pdf_filename: str):
         Return from process_image_with_border
     :param filename:
         Filename to write
+    :param jpeg_quality:
+        If specified, embed the image as a JPEG of this quality rather than a lossless PNG, producing a much smaller
+        PDF more quickly
     """
-    pdf = FPDF(unit='mm', format=(image_spec['page_width'], image_spec['page_height']))
-    with tempfile.TemporaryDirectory() as dirpath:
-        pdf.add_page()
-        image_spec['image'].save(f'{dirpath}/image.png')
-        pdf.image(f'{dirpath}/image.png',
+    pdf = MapPDF(unit='mm', format=(image_spec['page_width'], image_spec['page_height']))
+    pdf.add_page()
+    pdf.add_image(image_spec['image'],
                   image_spec['margin_left'],
                   image_spec['margin_top'],
                   image_spec['image_width'],
-                  image_spec['image_height'])
-        pdf.output(pdf_filename, 'F')
+                  image_spec['image_height'],
+                  jpeg_quality=jpeg_quality)
+    pdf.output(pdf_filename, 'F')
+
+
+class PageImages(Mapping):
+    """
+    Read-only mapping from 'x_y' page coordinates to the image for that page, as returned in the output of
+    split_image. Each page is cropped from the source image when it's looked up rather than all of them up front,
+    so a caller working through the pages one at a time, and closing each one when finished with it, only ever has
+    a single page's pixels in memory alongside the source. Pages are in row-major order, which walks through the
+    source image's rows sequentially and also puts the pages of the PDF in reading order.
+    """
+
+    def __init__(self, crop_for, pages_horizontal: int, pages_vertical: int):
+        """
+        :param crop_for:
+            Function taking page x and y coordinates and returning the cropped image for that page
+        :param pages_horizontal:
+            Number of pages across
+        :param pages_vertical:
+            Number of pages down
+        """
+        self.crop_for = crop_for
+        self.coords = {f'{x}_{y}': (x, y) for y, x in product(range(pages_vertical), range(pages_horizontal))}
+
+    def __getitem__(self, name):
+        return self.crop_for(*self.coords[name])
+
+    def __iter__(self):
+        return iter(self.coords)
+
+    def __len__(self):
+        return len(self.coords)
 
 
 def split_image(im: Image, squares_wide: float, squares_high: float, border_north=5, border_east=5, border_west=5,
@@ -310,7 +729,8 @@ def split_image(im: Image, squares_wide: float, squares_high: float, border_nort
     :param saturation:
         Set to >1.0 to enhance colour, <1.0 to remove it, None for no effect
     :return:
-        A dict of {pixels_per_mm:int, images:{name : image}, orientation:str[L|P], border:int}
+        A dict of {pixels_per_mm:int, images:PageImages, orientation:str[L|P], border:int}. The page images are only
+        cropped when they're read from the PageImages mapping
     """
 
     width_pixels, height_pixels = im.size
@@ -376,14 +796,20 @@ def split_image(im: Image, squares_wide: float, squares_high: float, border_nort
         overlap_south_pixels = pixels_per_mm * overlap_east
         borders = [border_east, border_south + overlap_east, border_west + overlap_south, border_north]
 
+    # Work out the pixel edges of every page once, rather than per page. Rounded in the same way as Image.crop would
+    # round them, so the crops are unchanged.
+    page_lefts = np.arange(pages_horizontal) * pixel_width_page
+    page_tops = np.arange(pages_vertical) * pixel_height_page
+    page_rights = np.minimum(width_pixels, page_lefts + pixel_width_page + overlap_east_pixels)
+    page_bottoms = np.minimum(height_pixels, page_tops + pixel_height_page + overlap_south_pixels)
+    page_lefts, page_tops, page_rights, page_bottoms = (np.round(edges).astype(int).tolist() for edges in
+                                                        (page_lefts, page_tops, page_rights, page_bottoms))
+
     def crop_for(page_x, page_y):
-        return im.crop((page_x * pixel_width_page, page_y * pixel_height_page,
-                        min(width_pixels, (page_x + 1) * pixel_width_page + overlap_east_pixels),
-                        min(height_pixels, (page_y + 1) * pixel_height_page + overlap_south_pixels)))
+        return im.crop((page_lefts[page_x], page_tops[page_y], page_rights[page_x], page_bottoms[page_y]))
 
     return {'pixels_per_mm': pixels_per_mm,
-            'images': {'{}_{}'.format(x, y): crop_for(x, y) for x in range(pages_horizontal) for y in
-                       range(pages_vertical)},
+            'images': PageImages(crop_for, pages_horizontal, pages_vertical),
             'orientation': orientation,
             'border': borders,
             'pages_horizontal': pages_horizontal,
@@ -391,7 +817,38 @@ def split_image(im: Image, squares_wide: float, squares_high: float, border_nort
             'paper': paper}
 
 
-def make_pdf(images, pdf_filename):
+def _encoded_tiles(images, jpeg_quality=None, threads=1):
+    """
+    Crop and encode the tiles from split_image in order, closing each once it's encoded. With more than one thread
+    the next few tiles are encoded in the background while the caller adds the current one to the PDF, Pillow and zlib
+    release the GIL while compressing so this runs on several cores. Only a couple of tiles per thread are ever in
+    flight, so memory use doesn't grow with the number of pages.
+
+    :return:
+        A generator of (coords, (width, height), image info) tuples
+    """
+
+    def encode(coords):
+        image = images['images'][coords]
+        try:
+            return coords, image.size, MapPDF.image_info(image, jpeg_quality)
+        finally:
+            image.close()
+
+    if threads <= 1:
+        yield from map(encode, images['images'])
+        return
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for coords in images['images']:
+            pending.append(executor.submit(encode, coords))
+            if len(pending) > threads * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def make_pdf(images, pdf_filename, jpeg_quality=None, threads=1):
     """
     Write a set of images from split_images into a combined A4 PDF file
 
@@ -399,9 +856,14 @@ def make_pdf(images, pdf_filename):
         The output dict from split_images
     :param pdf_filename:
         Full name of the PDF to write
+    :param jpeg_quality:
+        If specified, embed images as JPEGs of this quality rather than lossless PNGs, producing a much smaller PDF
+        more quickly
+    :param threads:
+        Number of threads to encode tiles with, defaults to 1
     """
     logging.info('make_pdf: Building PDF file {} from image data'.format(pdf_filename))
-    pdf = FPDF(orientation=images['orientation'], unit='mm', format=images['paper'].dimensions)
+    pdf = MapPDF(orientation=images['orientation'], unit='mm', format=images['paper'].dimensions)
     ppm = images['pixels_per_mm']
     border_north, border_east, border_south, border_west = images['border']
     if images['orientation'] == 'P':
@@ -434,44 +896,158 @@ def make_pdf(images, pdf_filename):
             else:
                 line(x, y + gap, x, y + size)
 
-    with tempfile.TemporaryDirectory() as dirpath:
-        for coords, image in images['images'].items():
-            pdf.add_page()
-
-            m = re.match(r'(\d+)_(\d+)', coords)
-            x = int(m.groups()[0])
-            y = int(m.groups()[1])
+    for coords, (im_width, im_height), info in _encoded_tiles(images, jpeg_quality, threads):
+        pdf.add_page()
 
-            im_width, im_height = image.size
+        # Keys are always built as x_y, no need for a regular expression to pull them apart
+        x, y = (int(n) for n in coords.split('_'))
 
-            im_width_mm = im_width / ppm
-            im_height_mm = im_height / ppm
-            last_vertical = y == images['pages_vertical'] - 1
-            last_horizontal = x == images['pages_horizontal'] - 1
+        im_width_mm = im_width / ppm
+        im_height_mm = im_height / ppm
+        last_vertical = y == images['pages_vertical'] - 1
+        last_horizontal = x == images['pages_horizontal'] - 1
 
-            # Always position the top left one the same
-            tick(border_west, border_north, n=True, w=True)
-            tick(border_west, border_north + im_height_mm, s=True, w=True)
-            tick(border_west + im_width_mm, border_north + im_height_mm, e=True, s=True)
-            tick(border_west + im_width_mm, border_north, e=True, n=True)
+        # Always position the top left one the same
+        tick(border_west, border_north, n=True, w=True)
+        tick(border_west, border_north + im_height_mm, s=True, w=True)
+        tick(border_west + im_width_mm, border_north + im_height_mm, e=True, s=True)
+        tick(border_west + im_width_mm, border_north, e=True, n=True)
 
-            if not last_horizontal:
-                tick(page_width - border_east, im_height_mm + border_north, s=True, dash=True)
-                tick(page_width - border_east, border_north, n=True, dash=True)
+        if not last_horizontal:
+            tick(page_width - border_east, im_height_mm + border_north, s=True, dash=True)
+            tick(page_width - border_east, border_north, n=True, dash=True)
 
-            if not last_vertical:
-                tick(border_west, page_height - border_south, w=True, dash=True)
-                tick(border_west + im_width_mm, page_height - border_south, e=True, dash=True)
+        if not last_vertical:
+            tick(border_west, page_height - border_south, w=True, dash=True)
+            tick(border_west + im_width_mm, page_height - border_south, e=True, dash=True)
 
-            # tick(page_width - border_east, border_north, n=True, e=True)
-            # tick(page_width - border_east, page_height - border_south, e=True, s=True)
-            image.save('{}/{}.png'.format(dirpath, coords))
-            pdf.image('{}/{}.png'.format(dirpath, coords), border_west, border_north, im_width / ppm,
-                      im_height / ppm)
+        # tick(page_width - border_east, border_north, n=True, e=True)
+        # tick(page_width - border_east, page_height - border_south, e=True, s=True)
+        pdf.add_image_info(info, border_west, border_north, im_width / ppm, im_height / ppm)
     pdf.output(pdf_filename, 'F')
     logging.info('make_pdf: Wrote {} images to PDF file {}'.format(len(images['images']), pdf_filename))
 
 
+def open_pdf(pdf_filename: str):
+    """
+    Open a PDF for reading, decrypting it with an empty password if necessary
+
+    :param pdf_filename:
+        Filename of the PDF to read
+    :return:
+        A PyPDF2 PdfFileReader
+    """
+    in_pdf = pdf.PdfFileReader(pdf_filename)
+    # Bug sometimes in PDFs with spaces in their filename (meh, whatever..)
+    if in_pdf.isEncrypted:
+        in_pdf.decrypt('')
+    return in_pdf
+
+
+@lru_cache(maxsize=8)
+def _open_pdf_cached(pdf_filename: str, mtime: float):
+    # Keyed on the modification time as well as the name, so a PDF which has changed since is read again
+    return open_pdf(pdf_filename)
+
+
+def _image_from_vobj(vobj, image_format: Literal[
+    "1", "CMYK", "F", "HSV", "I", "L", "LAB", "P", "RGB", "RGBA", "RGBX", "YCbCr"] = 'RGB'):
+    """
+    This isn't an ideal method, it seems to have to ignore a lot of exceptions and assertion failures
+    for some older PDF documents. It should, however, manage to extract most available images.
+
+    :param vobj:
+    :param image_format:
+    :return:
+    """
+    # if vobj['/Subtype'] == '/Form' and '/Resources' in vobj:
+    #     print('found a form, retrieving underlying xobj')
+    #     sub_object = vobj['/Resources']['/XObject']
+    #     for key in sub_object:
+    #         print(sub_object[key])
+    #         return image_from_vobj(sub_object[key])
+    if vobj['/Filter'] == '/FlateDecode':
+        # A raw bitmap
+        try:
+            buf = vobj.getData()
+            # Notice that we need metadata from the object
+            # so that we can make sense of the image data
+            size = int(vobj['/Width']), int(vobj['/Height'])
+            try:
+                if isinstance(buf, str):
+                    # Older versions of PyPDF2 hand back stream data as a str with one character per byte, latin-1
+                    # turns that back into the original bytes where UTF-8 would expand everything over 0x7f
+                    i = Image.frombytes(image_format, size, buf.encode('latin-1'), decoder_name='raw')
+                else:
+                    i = Image.frombytes(image_format, size, buf, decoder_name='raw')
+                return i
+            except ValueError as ve:
+                # We don't care about non-RGB images in this case
+                print(f'value error : {ve}, size={size}')
+                pass
+            except TypeError as te:
+                # Sometimes buf is a string, pretty sure this is wrong but hey
+                print(te)
+                pass
+        except AssertionError:
+            print('assertion error!')
+            # Seems to come up with some older PDFs, possibly when trying to interpret mask images
+            pass
+    elif vobj['/Filter'] == '/DCTDecode' or vobj['/Filter'] == '/JPXDecode':
+        # A compressed image
+        return Image.open(io.BytesIO(vobj._data))
+
+
+def _images_in_page(pdf_page, seen_images: set, min_width: int, min_height: int):
+    """
+    Find images within a page or form XObject, recursing into groups
+
+    :param pdf_page:
+        The page, or any other object with a /Resources dictionary
+    :param seen_images:
+        Set of indirect object IDs already returned, updated as new images are found
+    :param min_width:
+        Minimum width in pixels, below this images are rejected
+    :param min_height:
+        Minimum height in pixels, below this images are rejected
+    :return:
+        A generator of (object ID, image) tuples, the ID being None for images which aren't indirect objects
+    """
+    # Find the Resources block and look for images, or things into which we can recurse
+    r = pdf_page['/Resources']
+    if '/XObject' in r:
+        for k, v in r['/XObject'].items():
+            vobj = v.getObject()
+            idnum = v.idnum if isinstance(v, IndirectObject) else None
+            if vobj['/Subtype'] not in ['/Image'] or '/Filter' not in vobj:
+                # Reject things that aren't images but recurse into groups
+                if '/Resources' in vobj:
+                    yield from _images_in_page(vobj, seen_images, min_width, min_height)
+            elif idnum is not None and idnum in seen_images:
+                # Already returned this image from an earlier page, don't bother decoding it again
+                pass
+            elif int(vobj.get('/Width', 0)) < min_width or int(vobj.get('/Height', 0)) < min_height:
+                # The dimensions are in the image dictionary, so small images can be rejected without decoding
+                pass
+            elif img := _image_from_vobj(vobj):
+                if idnum is not None:
+                    seen_images.add(idnum)
+                # Only colour images are wanted. Adding an alpha channel turns anything with an RGB base mode, such as
+                # palette images, into RGBA, so check whether this one will end up as RGB before decoding its mask
+                has_mask = '/SMask' in vobj
+                if img.mode[:3] != 'RGB' and not (has_mask and Image.getmodebase(img.mode) == 'RGB'):
+                    continue
+                # Find an SMask if available and apply it
+                if mask_img := (_image_from_vobj(vobj['/SMask'], image_format='L') if has_mask else None):
+                    # Soft masks don't have to be the same resolution as the image they apply to, but putalpha needs
+                    # them to be
+                    if mask_img.size != img.size:
+                        mask_img = mask_img.resize(img.size, resample=Image.BILINEAR)
+                    img.putalpha(mask_img)
+                if img.mode[:3] == 'RGB':
+                    yield idnum, img
+
+
 def extract_images_from_pdf(pdf_filename: str, page=None, to_page=None, min_width=100, min_height=100):
     """
     Pull images out of a PDF file by page range, including finding any SMask elements and applying them
@@ -490,90 +1066,97 @@ def extract_images_from_pdf(pdf_filename: str, page=None, to_page=None, min_widt
     :param min_height:
         Minimum height in pixels, below this images are rejected
     :return:
-        A generator of images from this PDF
+        A generator of images from this PDF. Images are decoded one at a time as the generator is advanced, so only
+        the current image needs to be held in memory - avoid wrapping this in list() unless you really need every
+        image at once. The generator can only be consumed once.
     """
-
-    def image_from_vobj(vobj, image_format: Literal[
-        "1", "CMYK", "F", "HSV", "I", "L", "LAB", "P", "RGB", "RGBA", "RGBX", "YCbCr"] = 'RGB'):
-        """
-        This isn't an ideal method, it seems to have to ignore a lot of exceptions and assertion failures
-        for some older PDF documents. It should, however, manage to extract most available images.
-
-        :param vobj:
-        :param image_format:
-        :return:
-        """
-        # if vobj['/Subtype'] == '/Form' and '/Resources' in vobj:
-        #     print('found a form, retrieving underlying xobj')
-        #     sub_object = vobj['/Resources']['/XObject']
-        #     for key in sub_object:
-        #         print(sub_object[key])
-        #         return image_from_vobj(sub_object[key])
-        if vobj['/Filter'] == '/FlateDecode':
-            # A raw bitmap
-            try:
-                buf = vobj.getData()
-                # Notice that we need metadata from the object
-                # so that we can make sense of the image data
-                size = int(vobj['/Width']), int(vobj['/Height'])
-                try:
-                    if isinstance(buf, str):
-                        i = Image.frombytes(image_format, size, bytes(buf, 'UTF-8'), decoder_name='raw')
-                    else:
-                        i = Image.frombytes(image_format, size, buf, decoder_name='raw')
-                    return i
-                except ValueError as ve:
-                    # We don't care about non-RGB images in this case
-                    print(f'value error : {ve}, size={size}')
-                    pass
-                except TypeError as te:
-                    # Sometimes buf is a string, pretty sure this is wrong but hey
-                    print(te)
-                    pass
-            except AssertionError:
-                print('assertion error!')
-                # Seems to come up with some older PDFs, possibly when trying to interpret mask images
-                pass
-        elif vobj['/Filter'] == '/DCTDecode' or vobj['/Filter'] == '/JPXDecode':
-            # A compressed image
-            return Image.open(io.BytesIO(vobj._data))
-
+    in_pdf = open_pdf(pdf_filename)
     # Keep track of indirect images we've seen
     seen_images = set()
-
-    def images_in_page(pdf_page):
-        # Find the Resources block and look for images, or things into which we can recurse
-        r = pdf_page['/Resources']
-        if '/XObject' in r:
-            for k, v in r['/XObject'].items():
-                vobj = v.getObject()
-                if vobj['/Subtype'] not in ['/Image'] or '/Filter' not in vobj:
-                    # Reject things that aren't images but recurse into groups
-                    if '/Resources' in vobj:
-                        for sub_image in images_in_page(vobj):
-                            if sub_image:
-                                yield sub_image
-                elif img := image_from_vobj(vobj):
-                    if isinstance(v, IndirectObject) and v.idnum in seen_images:
-                        pass
-                    else:
-                        # Find an SMask if available and apply it
-                        if mask_img := (
-                                image_from_vobj(vobj['/SMask'], image_format='L') if '/SMask' in vobj else None):
-                            img.putalpha(mask_img)
-                        if isinstance(v, IndirectObject):
-                            seen_images.add(v.idnum)
-                        yield img
-
-    # Read in the PDF file
-    in_pdf = pdf.PdfFileReader(pdf_filename)
-    # Bug sometimes in PDFs with spaces in their filename (meh, whatever..)
-    if in_pdf.isEncrypted:
-        in_pdf.decrypt('')
     # Iterate over target page range, and over images in each page
     for page_number in range(max(0, page or 0),
                              min(to_page or in_pdf.getNumPages(), in_pdf.getNumPages())):
-        for image in images_in_page(in_pdf.getPage(page_number)):
-            width, height = image.size
-            if width >= min_width and height >= min_height and image.mode[:3] == 'RGB':
-                yield image
+        for _, image in _images_in_page(in_pdf.getPage(page_number), seen_images, min_width, min_height):
+            yield image
+
+
+def _image_ids_in_page(pdf_page, image_ids: list):
+    # Same traversal as _images_in_page, but only collecting the IDs of indirect image objects, without decoding
+    r = pdf_page['/Resources']
+    if '/XObject' in r:
+        for v in r['/XObject'].values():
+            vobj = v.getObject()
+            if vobj['/Subtype'] == '/Image':
+                if isinstance(v, IndirectObject):
+                    image_ids.append(v.idnum)
+            elif '/Resources' in vobj:
+                _image_ids_in_page(vobj, image_ids)
+
+
+def skip_ids_by_page(in_pdf, page_numbers):
+    """
+    Work out which images each page can skip because they've already appeared on an earlier page. Only the page and
+    XObject dictionaries are read, no images are decoded, so this is cheap to run up front and lets pages then be
+    extracted in any order, or in parallel, while still only decoding each image once.
+
+    :param in_pdf:
+        An open PdfFileReader
+    :param page_numbers:
+        Zero based page numbers, in the order in which their images will be written
+    :return:
+        A list of frozensets of object IDs, one for each page number, to pass as skip_ids to
+        extract_png_images_from_pdf_page
+    """
+    first_pages = {}
+    skip_ids = []
+    try:
+        for page_number in page_numbers:
+            image_ids = []
+            _image_ids_in_page(in_pdf.getPage(page_number), image_ids)
+            skip_ids.append(frozenset(idnum for idnum in image_ids if first_pages.setdefault(idnum, page_number) !=
+                                      page_number))
+            # Don't keep the raw image streams read along the way
+            in_pdf.resolvedObjects.clear()
+    finally:
+        in_pdf.resolvedObjects.clear()
+    return skip_ids
+
+
+def extract_png_images_from_pdf_page(pdf_filename: str, page_number: int, min_width=100, min_height=100,
+                                     skip_ids=frozenset()):
+    """
+    Pull images from a single page of a PDF and encode them as PNG. This is the unit of work for parallel
+    extraction, it opens the PDF itself and returns plain bytes so it can be run in a worker process without
+    having to pickle reader or image objects.
+
+    :param pdf_filename:
+        Filename of the PDF to read
+    :param page_number:
+        Zero based page number
+    :param min_width:
+        Minimum width in pixels, below this images are rejected
+    :param min_height:
+        Minimum height in pixels, below this images are rejected
+    :param skip_ids:
+        Object IDs of images not to decode, usually those already extracted from earlier pages, from skip_ids_by_page
+    :return:
+        A list of (object ID, PNG bytes) tuples in page order. The object ID is None for inline images, otherwise
+        it can be used to drop images which appear on more than one page.
+    """
+    # This is called once for every page, keep the reader open between calls rather than reading the cross reference
+    # table and page tree again each time
+    pdf_filename = abspath(pdf_filename)
+    in_pdf = _open_pdf_cached(pdf_filename, getmtime(pdf_filename))
+    results = []
+    try:
+        for idnum, image in _images_in_page(in_pdf.getPage(page_number), set(skip_ids), min_width,
+                                                min_height):
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG')
+            image.close()
+            results.append((idnum, buffer.getvalue()))
+    finally:
+        # PyPDF2 keeps every object it has read, along with the decoded data for streams, drop them so the images
+        # from this page don't stay in memory. They can be read again from the file if they're needed later.
+        in_pdf.resolvedObjects.clear()
+    return results
@@ -1,9 +1,16 @@
+import functools
+import hashlib
 import logging
+import math
+import multiprocessing
+import os
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from os import scandir
-from os.path import abspath, isfile
-from pathfinder.utils import ensure_dir, Config
-from pathfinder.mapmaker.waifu2x_pytorch import Waifu2x
+from os.path import join
+from pathfinder.utils import input_and_output_dirs, Config, FileCache
 from PIL import Image
 
 from pathfinder import mapmaker
@@ -36,47 +43,308 @@ parser.add_argument('-o', '--overlap', type=float,
 parser.add_argument('-a', '--paper_size', type=str,
                     help=f'tiled mode only - paper size from [{"|".join([p.name for p in mapmaker.Paper])}], default {conf.map_default_paper}',
                     default=conf.map_default_paper)
-parser.add_argument('-m', '--mode', type=str,
+parser.add_argument('-m', '--mode', type=str, nargs='+',
                     help=f'mode, from [tiled|single|png], default {conf.map_default_mode}. Tiled mode produces a multi-page PDF with pages ' +
                          'of the requested size. Single mode produces a single PDF exactly fitting the map, and PNG mode produces a lower size PNG ' +
-                         'image suitable for virtual tabletops such as Roll20',
-                    default=conf.map_default_mode)
-parser.add_argument('-x', '--preset', type=str,
-                    help=f'preset, overrides settings from presets within the config file, available presets are [{"|".join(conf.map_presets.keys())}]',
+                         'image suitable for virtual tabletops such as Roll20. Several modes can be given to build each map in each of them ' +
+                         'in a single run, only upscaling it once',
+                    default=[conf.map_default_mode])
+parser.add_argument('-x', '--preset', type=str, nargs='+',
+                    help=f'preset, overrides settings from presets within the config file, available presets are [{"|".join(conf.map_presets.keys())}]. ' +
+                         'Several presets can be given to build each map with each of them in a single run',
                     default=None)
+parser.add_argument('-q', '--jpeg', type=int,
+                    help='tiled and single modes only - embed images without transparency in the PDF as JPEGs of this ' +
+                         'quality (1-95), producing much smaller files more quickly, or 0 to use lossless PNGs. ' +
+                         'Default %(default)s',
+                    default=conf.get('map_default_jpeg', default=92))
+parser.add_argument('-j', '--jobs', type=int,
+                    help='number of maps to process in parallel, default is the number of CPUs up to a maximum of 6',
+                    default=conf.get('map_default_jobs', default=min(os.cpu_count() or 1, 6)))
+parser.add_argument('--gpu-jobs', type=int,
+                    help='maximum number of maps to upscale on the GPU at the same time, default 1',
+                    default=conf.get('map_default_gpu_jobs', default=1))
+parser.add_argument('--no-cache', action='store_true',
+                    help='always run waifu2x rather than reusing upscaled images cached by previous runs, and don\'t ' +
+                         'add the results to the cache')
 
 
-def main():
-    options = parser.parse_args()
+@dataclass
+class MapResult:
+    """
+    Outcome of processing a single file from the input directory
+    """
+    name: str
+    status: str
+    error: str = None
+    time_ms: float = 0
 
-    waifu2x = Waifu2x()
 
-    # Get directories - if the output DIR isn't specified we use the same as the input
-    input_dir = abspath(options.input_dir)
-    if options.output_dir is None:
-        output_dir = input_dir
-    else:
-        output_dir = abspath(options.output_dir)
-    # Check and build input / output directories
-    if not ensure_dir(input_dir, create=False):
-        exit(1)
-    if not ensure_dir(output_dir):
-        exit(1)
+# Waifu2x instance for this process, created on first use so each worker process loads the model exactly once
+_waifu2x = None
+
+# This worker process's share of the CPU cores, used as the number of threads for waifu2x when running on the CPU and
+# for encoding PDF tiles, set in each worker process by _init_worker
+_torch_threads = None
+
+# Semaphore shared by all worker processes limiting how many can use the GPU at once, set by _init_worker
+_gpu_semaphore = None
+
+# Cache of upscaled images, so re-running with different enhancement or layout options doesn't repeat the upscale
+_upscale_cache = None
+
+# Whether to use the upscale cache, set by _init_worker
+_use_cache = True
+
+
+def run_waifu2x(i: Image, width: float, height: float, gridsize: int) -> Image:
+    """
+    Scale an image up with waifu2x until each grid square is within a factor of root two of gridsize pixels across,
+    then resize it to exactly gridsize pixels per square. Unless disabled with --no-cache, results are cached on disk,
+    keyed on a hash of the source pixels and the target size, so repeated runs over the same map only pay for the
+    upscale once.
+
+    :param i:
+        Image to scale
+    :param width:
+        Width of the map in squares
+    :param height:
+        Height of the map in squares
+    :param gridsize:
+        Target size of each square in pixels
+    :return:
+        The scaled image
+    """
+    global _upscale_cache
+    target_size = (int(width * gridsize), int(height * gridsize))
+    if i.size == target_size:
+        # Callers open the source in a with block, so hand back a loaded copy rather than an image about to be closed
+        return i.copy()
+    if not _use_cache:
+        return _upscale(i, target_size)
+    if _upscale_cache is None:
+        _upscale_cache = FileCache(join(conf.dir, 'cache', 'waifu2x'),
+                                   max_size_mb=conf.get('map_cache_size', default=2048))
+    key = hashlib.blake2b(i.tobytes(), digest_size=16).hexdigest()
+    key = f'{key}_{i.mode}{i.size[0]}x{i.size[1]}_{target_size[0]}x{target_size[1]}.png'
+    cached = _upscale_cache.get(key)
+    if cached is not None:
+        logging.info(f'Using cached upscaled image {cached}')
+        i = Image.open(cached)
+        i.load()
+        return i
+    i = _upscale(i, target_size)
+    _upscale_cache.put(key, lambda filename: i.save(filename, format='PNG', compress_level=1))
+    return i
+
+
+def _upscale(i: Image, target_size) -> Image:
+    """
+    Run waifu2x and resize to the target size, without going through the cache
+    """
+    global _waifu2x
+    # Work out how many passes are needed to reach the right gridsize, then run them all in one go. Stop once the image
+    # is within a factor of root two of the target, a doubling from there is mostly thrown away again by the resize
+    # below and LANCZOS handles the remaining factor well enough, so it's not worth a whole extra waifu2x pass
+    passes = 0
+    while i.size[0] * 2 ** passes * math.sqrt(2) < target_size[0]:
+        passes += 1
+    if passes:
+        if _waifu2x is None:
+            # Imported here as loading torch is slow, and not needed at all if everything comes from the cache
+            from pathfinder.mapmaker.waifu2x_pytorch import Waifu2x
+            _waifu2x = Waifu2x(threads=_torch_threads)
+        if _waifu2x.cuda and _gpu_semaphore is not None:
+            # Several workers upscaling at once on the same GPU just contend for its memory, so take turns. Other
+            # workers carry on with the CPU bound enhancement, tiling and PDF work in the meantime
+            with _gpu_semaphore:
+                i = _waifu2x.scale(i, passes=passes)
+        else:
+            i = _waifu2x.scale(i, passes=passes)
+    # Then scale the image back down to the target size. When the source is already much larger than the target, take
+    # out whole multiples with a cheap box filter first so LANCZOS only has to handle the remaining factor
+    reduce_factor = min(i.size[0] // target_size[0], i.size[1] // target_size[1])
+    if reduce_factor >= 2:
+        i = i.reduce(reduce_factor)
+    return i.resize(target_size, resample=Image.LANCZOS)
+
+
+def _init_worker(torch_threads, gpu_semaphore=None, use_cache=True):
+    """
+    Set up a worker process, called once in each process in the pool before it runs any jobs
+
+    :param torch_threads:
+        Number of threads waifu2x should use if it has to run on the CPU
+    :param gpu_semaphore:
+        Semaphore to hold while upscaling on the GPU, or None for no limit
+    :param use_cache:
+        Whether to read and write upscaled images from the on-disk cache
+    """
+    global _torch_threads, _gpu_semaphore, _use_cache
+    _torch_threads = torch_threads
+    _gpu_semaphore = gpu_semaphore
+    _use_cache = use_cache
+
+
+def process_entry(entry_path, output_dir, mode, paper_size, page_border, saturation, sharpen, brighten, overlap,
+                  gridsize, jpeg_quality=None, upscale=None):
+    """
+    Build the output for a single map image. This runs in a worker process, so all arguments must be picklable.
+
+    :param entry_path:
+        Full path of the image file
+    :param upscale:
+        Function called with the filename, width, height and gridsize to get the upscaled image, only called if the
+        output isn't already up to date. Defaults to None to open the file and run it through run_waifu2x
+    :return:
+        A MapResult with the status, one of 'built', 'exists', 'skipped' or 'error', and the time taken
+    """
+    t0 = time.perf_counter()
+    try:
+        status = _process_entry(entry_path, output_dir, mode, paper_size, page_border, saturation, sharpen, brighten,
+                                overlap, gridsize, jpeg_quality, upscale or _open_and_upscale)
+        error = None
+    except Exception as e:
+        # Don't let one bad map take down the whole run, report it at the end instead
+        logging.exception(f'Unable to process {entry_path}')
+        status, error = 'error', repr(e)
+    return MapResult(name=os.path.basename(entry_path), status=status, error=error,
+                     time_ms=(time.perf_counter() - t0) * 1000)
+
+
+def process_entry_presets(entry_path, preset_settings, output_dir):
+    """
+    Build the output for a single map image with each of several sets of settings in turn. The settings must all
+    have the same gridsize, the map is then upscaled at most once and the result shared between them, the first time
+    one of them finds its output needs building.
+
+    :param entry_path:
+        Full path of the image file
+    :param preset_settings:
+        List of (preset name, settings dict) tuples, the settings being keyword arguments for process_entry
+    :param output_dir:
+        Directory to write to
+    :return:
+        A list of (preset name, MapResult) tuples
+    """
+    upscaled = []
+
+    def upscale(filename, width, height, gridsize):
+        if not upscaled:
+            upscaled.append(_open_and_upscale(filename, width, height, gridsize))
+        return upscaled[0]
+
+    return [(preset, process_entry(entry_path, output_dir=output_dir, upscale=upscale, **settings)) for
+            preset, settings in preset_settings]
+
+
+def _up_to_date(output_filename, source_filename):
+    """
+    Check whether an output file exists and is at least as new as the source image it was built from, so replacing a
+    map image with a new version causes its outputs to be rebuilt
 
+    :param output_filename:
+        Output file to check
+    :param source_filename:
+        Source image
+    :return:
+        True if the output can be used as it is, False if it needs to be built
+    """
+    try:
+        return os.stat(output_filename).st_mtime_ns >= os.stat(source_filename).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def _open_and_upscale(filename, width, height, gridsize):
+    with Image.open(filename) as source:
+        return run_waifu2x(source, width, height, gridsize)
+
+
+def _process_entry(entry_path, output_dir, mode, paper_size, page_border, saturation, sharpen, brighten, overlap,
+                   gridsize, jpeg_quality, upscale):
+    try:
+        logging.info(f'entry = {entry_path}')
+        filename, _, name, width, height = mapmaker.parse_filename(entry_path)
+    except ValueError:
+        return 'skipped'
+    logging.info(f'Processing {name}, width={width}, height={height}, mode={mode}')
+    quality_suffix = f'q{jpeg_quality}' if jpeg_quality is not None else ''
+
+    if mode == 'PNG':
+        png_filename = join(output_dir, f'{name}_c{saturation}s{sharpen}b{brighten}_{width}x{height}.png')
+        if not _up_to_date(png_filename, filename):
+            image = upscale(filename, width, height, gridsize)
+            image = mapmaker.basic_image_ops(image, brighten, sharpen, saturation)
+            image.save(fp=png_filename, format='PNG')
+        else:
+            logging.info(f'File {png_filename} is up to date, skipping.')
+            return 'exists'
+
+    elif mode == 'SINGLE':
+        pdf_filename = join(output_dir, f'{name}_exact_p{page_border}c{saturation}s{sharpen}b{brighten}{quality_suffix}.pdf')
+        if not _up_to_date(pdf_filename, filename):
+            image = upscale(filename, width, height, gridsize)
+            image_spec = mapmaker.process_image_with_border(im=image, squares_wide=width,
+                                                            squares_high=height,
+                                                            border_north=page_border,
+                                                            border_east=page_border,
+                                                            border_south=page_border,
+                                                            border_west=page_border,
+                                                            brighten=brighten, sharpen=sharpen,
+                                                            saturation=saturation)
+            mapmaker.make_single_page_pdf(image_spec, pdf_filename, jpeg_quality=jpeg_quality)
+        else:
+            logging.info(f'File {pdf_filename} is up to date, skipping.')
+            return 'exists'
+
+    elif mode == 'TILED':
+        pdf_filename = join(output_dir, f'{name}_{paper_size.name}_p{page_border}c{saturation}s{sharpen}b{brighten}o{overlap}{quality_suffix}.pdf')
+        if not _up_to_date(pdf_filename, filename):
+            image = upscale(filename, width, height, gridsize)
+            split = mapmaker.split_image(im=image, squares_wide=width, squares_high=height,
+                                         border_north=page_border, border_east=page_border,
+                                         border_south=page_border,
+                                         border_west=page_border,
+                                         brighten=brighten, sharpen=sharpen, saturation=saturation,
+                                         overlap_east=overlap,
+                                         overlap_south=overlap, paper=paper_size)
+            mapmaker.make_pdf(split, pdf_filename, jpeg_quality=jpeg_quality, threads=_torch_threads or 1)
+        else:
+            logging.info(f'File {pdf_filename} is up to date, skipping.')
+            return 'exists'
+
+    return 'built'
+
+
+def settings_for_preset(options, preset=None, mode=None):
+    """
+    Work out the settings for process_entry from the command line options, overridden by a preset if specified
+
+    :param options:
+        Parsed command line options
+    :param preset:
+        Name of a preset from the config file, or None to use the command line options as they are
+    :param mode:
+        One of the modes from the command line, defaults to the first. Presets which specify a mode override this
+    :return:
+        A dict of keyword arguments for process_entry, or None if the settings aren't usable
+    """
     # Get values from command line parser
     page_border = options.padding
     saturation = options.colour
     sharpen = options.sharpen
     brighten = options.brighten
     overlap = options.overlap
-    mode = options.mode
+    mode = mode or options.mode[0]
     specified_paper_size = options.paper_size
     gridsize = options.gridsize
+    jpeg_quality = options.jpeg
 
     # Load from presets if specified
-    if options.preset is not None:
-        p = f'map_presets_{options.preset}_'
-        page_border = conf.get(p + 'border', default=page_border)
+    if preset is not None:
+        p = f'map_presets_{preset}_'
+        page_border = conf.get(p + 'padding', default=conf.get(p + 'border', default=page_border))
         saturation = conf.get(p + 'saturation', default=saturation)
         sharpen = conf.get(p + 'sharpen', default=sharpen)
         brighten = conf.get(p + 'brighten', default=brighten)
@@ -84,74 +352,101 @@ def main():
         specified_paper_size = conf.get(p + 'paper', default=specified_paper_size)
         mode = conf.get(p + 'mode', default=mode)
         gridsize = conf.get(p + 'gridsize', default=gridsize)
+        jpeg_quality = conf.get(p + 'jpeg', default=jpeg_quality)
 
     # Try to parse out paper size
     try:
         paper_size = mapmaker.Paper[specified_paper_size.upper()]
     except KeyError:
-        logging.info(f'Paper size {options.paper_size} not found.')
+        logging.info(f'Paper size {specified_paper_size} not found.')
         paper_size = None
 
+    # Normalise the mode once here rather than for every map, and fail now on one we don't know rather than quietly
+    # skipping every map later
+    mode = mode.upper()
+    if mode not in ('PNG', 'SINGLE', 'TILED'):
+        logging.error(f'Unknown mode {mode}, must be one of tiled, single or png')
+        return None
+
     # Fail if we're in tiled mode and there's no paper size defined
-    if paper_size is None and mode.upper() == 'TILED':
-        logging.error('Tiled mode requires a valid paper size, aborting')
-        exit(0)
+    if paper_size is None and mode == 'TILED':
+        logging.error('Tiled mode requires a valid paper size')
+        return None
 
-    def run_waifu2x(i: Image) -> Image:
-        # Scale up until we have the right gridsize
-        while (i.size[0] < width * gridsize):
-            i = waifu2x.scale(i)
-        # Then scale the image back down to the target size
-        return i.resize((int(width * gridsize), int(height * gridsize)), resample=Image.LANCZOS)
+    return dict(mode=mode, paper_size=paper_size, page_border=page_border, saturation=saturation, sharpen=sharpen,
+                brighten=brighten, overlap=overlap, gridsize=gridsize, jpeg_quality=jpeg_quality or None)
 
+
+def main():
+    options = parser.parse_args()
+
+    # Get directories - if the output DIR isn't specified we use the same as the input
+    dirs = input_and_output_dirs(options.input_dir, options.output_dir)
+    if dirs is None:
+        exit(1)
+    input_dir, output_dir = dirs
+
+    # One set of settings per preset and mode, so a sweep over several presets or modes shares a single pool of
+    # workers, each of which only loads waifu2x once, and each map is only upscaled once per gridsize.
+    # Settings are labelled with whichever of the preset and mode vary, to tell the results apart
+    presets = options.preset or [None]
+    settings = {}
+    for preset in presets:
+        for mode in options.mode:
+            preset_settings = settings_for_preset(options, preset, mode)
+            if preset_settings is None:
+                logging.error('Unable to use the requested settings, aborting')
+                exit(0)
+            # A preset which sets its own mode gives the same settings whichever mode was asked for, only build once
+            if preset_settings not in settings.values():
+                label = ', '.join(([preset] if len(presets) > 1 else []) +
+                                  ([preset_settings['mode'].lower()] if len(options.mode) > 1 else []))
+                settings[label] = preset_settings
+
+    # First pass - find all the files which look like maps. Checking the name against the pattern is much cheaper than
+    # letting parse_filename raise and catching the ValueError, which matters in directories with lots of other files
+    entries = []
     for entry in scandir(path=input_dir):
-        try:
-            logging.info(f'entry = {entry}')
-            filename, _, name, width, height = mapmaker.parse_filename(abspath(input_dir + '/' + entry.name))
-            logging.info(f'Processing {name}, width={width}, height={height}, mode={mode}')
-
-            if mode.upper() == 'PNG':
-                png_filename = f'{output_dir}/{name}_c{saturation}s{sharpen}b{brighten}_{width}x{height}.png'
-                if not isfile(png_filename):
-                    image = Image.open(filename)
-                    image = run_waifu2x(image)
-                    image = mapmaker.basic_image_ops(image, brighten, sharpen, saturation)
-                    image.save(fp=png_filename, format='PNG')
-                else:
-                    logging.info(f'File {png_filename} already exists, skipping.')
-
-            elif mode.upper() == 'SINGLE':
-                pdf_filename = f'{output_dir}/{name}_exact_p{page_border}c{saturation}s{sharpen}b{brighten}.pdf'
-                if not isfile(pdf_filename):
-                    image = Image.open(filename)
-                    image = run_waifu2x(image)
-                    image_spec = mapmaker.process_image_with_border(im=image, squares_wide=width,
-                                                                    squares_high=height,
-                                                                    border_north=page_border,
-                                                                    border_east=page_border,
-                                                                    border_south=page_border,
-                                                                    border_west=page_border,
-                                                                    brighten=brighten, sharpen=sharpen,
-                                                                    saturation=saturation)
-                    mapmaker.make_single_page_pdf(image_spec, pdf_filename)
-                else:
-                    logging.info(f'File {pdf_filename} already exists, skipping.')
-
-            elif mode.upper() == 'TILED':
-                pdf_filename = f'{output_dir}/{name}_{paper_size.name}_p{page_border}c{saturation}s{sharpen}b{brighten}o{overlap}.pdf'
-                if not isfile(pdf_filename):
-                    image = Image.open(filename)
-                    image = run_waifu2x(image)
-                    split = mapmaker.split_image(im=image, squares_wide=width, squares_high=height,
-                                                 border_north=page_border, border_east=page_border,
-                                                 border_south=page_border,
-                                                 border_west=page_border,
-                                                 brighten=brighten, sharpen=sharpen, saturation=saturation,
-                                                 overlap_east=overlap,
-                                                 overlap_south=overlap, paper=paper_size)
-                    mapmaker.make_pdf(split, pdf_filename)
-                else:
-                    logging.info(f'File {pdf_filename} already exists, skipping.')
-
-        except ValueError:
+        if mapmaker.MAP_FILENAME.match(entry.name) and entry.is_file():
+            entries.append(entry.path)
+        else:
             logging.debug('Unable to parse details from {}, skipping'.format(entry.name))
+
+    # Second pass - build the jobs. Presets with the same gridsize need the same upscaled image, so they go to the same
+    # worker as a single job which only upscales the map once, rather than several workers upscaling the same map at
+    # the same time
+    presets_by_gridsize = {}
+    for label, preset_settings in settings.items():
+        presets_by_gridsize.setdefault(preset_settings['gridsize'], []).append(label)
+    jobs = [(entry_path, [(label, settings[label]) for label in group]) for entry_path in entries for group in
+            presets_by_gridsize.values()]
+
+    # Each job is independent, so farm them out to a pool of worker processes. Split the cores between the workers
+    # for CPU upscaling, torch would otherwise start a thread per core in every worker and they'd all fight each other
+    workers = max(1, min(options.jobs, len(jobs)))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(max(1, (os.cpu_count() or 1) // workers),
+                                       multiprocessing.BoundedSemaphore(options.gpu_jobs),
+                                       not options.no_cache)) as executor:
+        results = []
+        for job_results in executor.map(functools.partial(process_entry_presets, output_dir=output_dir),
+                                        [entry_path for entry_path, _ in jobs],
+                                        [preset_settings for _, preset_settings in jobs]):
+            for label, result in job_results:
+                if len(settings) > 1:
+                    result.name = f'{result.name} [{label}]'
+                results.append(result)
+
+    # Summarise everything that was looked at, slowest first, so it's obvious where the time went and what failed
+    results = sorted((result for result in results if result.status != 'skipped'), key=lambda r: r.time_ms,
+                     reverse=True)
+    if results:
+        name_width = max(len(result.name) for result in results)
+        print(f'{"map":<{name_width}}  {"status":<7}  {"time":>9}')
+        for result in results:
+            print(f'{result.name:<{name_width}}  {result.status:<7}  {result.time_ms / 1000:>8.1f}s' +
+                  (f'  {result.error}' if result.error else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,81 @@
+import functools
+import hashlib
 import logging
+import os
+import pickle
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 from os import makedirs
-from os.path import abspath
+from os.path import abspath, join
 from pathlib import Path
 
-from pathfinder.mapmaker import extract_images_from_pdf
+from pathfinder.mapmaker import extract_png_images_from_pdf_page, open_pdf, skip_ids_by_page
+from pathfinder.utils import Config, FileCache
 
 logging.basicConfig(level=logging.INFO)
 
+conf = Config()
+
 parser = ArgumentParser()
 parser.add_argument('input_pdf', type=str, help='search INPUT_PDF for map images')
 parser.add_argument('output_dir', type=str, help='write images to OUTPUT_DIR, will be created if not found')
 parser.add_argument('-p', '--page', type=int, help='optionally only extract from the given page', default=None)
 parser.add_argument('-t', '--topage', type=int, help='optionally extract up to the given page (inclusive)',
                     default=None)
+parser.add_argument('-j', '--jobs', type=int, help='number of pages to extract in parallel, defaults to %(default)s',
+                    default=min(os.cpu_count() or 1, 4))
+
+# Images smaller than this in either direction are never maps, so aren't extracted
+MIN_SIZE = 100
+
+
+def file_digest(filename):
+    """
+    Hash the contents of a file, reading it in chunks so large PDFs don't have to be held in memory
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def extract_page(pdf_filename, pdf_digest, page_number, skip_ids=frozenset()):
+    """
+    Extract the images from a single page as PNG bytes, using the results from an earlier run over the same PDF if
+    there are any. Cached on disk keyed on the hash of the PDF, so repeatedly extracting from a PDF while preparing
+    maps only pays for decoding its images once.
+
+    :param pdf_filename:
+        Filename of the PDF to read
+    :param pdf_digest:
+        Hash of the PDF file contents from file_digest
+    :param page_number:
+        Zero based page number
+    :param skip_ids:
+        Object IDs of images which have already been extracted from earlier pages, and so shouldn't be decoded again
+    :return:
+        The list of (object ID, PNG bytes) from extract_png_images_from_pdf_page
+    """
+    cache = FileCache(join(conf.dir, 'cache', 'extract'), max_size_mb=conf.get('map_cache_size', default=2048))
+    key = f'{pdf_digest}_{page_number}_{MIN_SIZE}'
+    if skip_ids:
+        # Which images are skipped depends on the page range being extracted, so is part of the key
+        key += '_' + hashlib.blake2b(','.join(map(str, sorted(skip_ids))).encode('ascii'), digest_size=8).hexdigest()
+    key += '.pkl'
+    cached = cache.get(key)
+    if cached is not None:
+        with open(cached, 'rb') as f:
+            return pickle.load(f)
+    page_images = extract_png_images_from_pdf_page(pdf_filename, page_number, min_width=MIN_SIZE, min_height=MIN_SIZE,
+                                                   skip_ids=skip_ids)
+
+    def write(filename):
+        with open(filename, 'wb') as f:
+            pickle.dump(page_images, f)
+
+    cache.put(key, write)
+    return page_images
 
 
 def main():
@@ -37,12 +99,38 @@ def main():
     else:
         logging.info('Using existing output directory {}'.format(output_dir))
 
-    for index, image in enumerate(extract_images_from_pdf(pdf_filename=pdf_filename,
-                                                          min_height=100,
-                                                          min_width=100,
-                                                          page=page - 1 if page is not None else None,
-                                                          to_page=to_page if to_page else page)):
-        image.save('{}/image-{}.png'.format(output_dir, index))
+    first_page = page - 1 if page is not None else None
+    last_page = to_page if to_page else page
+    in_pdf = open_pdf(pdf_filename)
+    page_count = in_pdf.getNumPages()
+    page_numbers = range(max(0, first_page or 0), min(last_page or page_count, page_count))
+    # Find out up front which images appear on more than one page, so each is only decoded for the first page it's on
+    # even when the pages are extracted in parallel
+    skip_ids = skip_ids_by_page(in_pdf, page_numbers)
+    del in_pdf
+    extract = functools.partial(extract_page, pdf_filename, file_digest(pdf_filename))
+
+    def write_images(pages):
+        # Images come back as PNG bytes in page order and are written here, dropping any which have already appeared
+        # on an earlier page. Workers already skip those through skip_ids, so this is only a safety net
+        seen_images = set()
+        index = 0
+        for page_images in pages:
+            for idnum, png_bytes in page_images:
+                if idnum is not None:
+                    if idnum in seen_images:
+                        continue
+                    seen_images.add(idnum)
+                with open(join(output_dir, 'image-{}.png'.format(index)), 'wb') as f:
+                    f.write(png_bytes)
+                index += 1
+
+    if options.jobs > 1:
+        # Each page is decoded in its own worker process
+        with ProcessPoolExecutor(max_workers=options.jobs) as executor:
+            write_images(executor.map(extract, page_numbers, skip_ids))
+    else:
+        write_images(map(extract, page_numbers, skip_ids))
 
     print("""Done - images written to {}. 
     
@@ -1,12 +1,11 @@
-from PIL import Image
-from guizero import App, Picture
 from pathlib import Path
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathfinder.mapmaker import ImageGrid
 from argparse import ArgumentParser
 from os import scandir
-from os.path import abspath, isfile
-from pathfinder.utils import ensure_dir, Config
+from pathfinder.utils import input_and_output_dirs
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -17,22 +16,47 @@ parser.add_argument('output_dir', nargs='?', type=str,
                     help='write images to OUTPUT_DIR, will be created if not found. ' +
                          'If not supplied, will use INPUT_DIR',
                     default=None)
+parser.add_argument('--auto', action='store_true',
+                    help='find the grid in each image automatically rather than by clicking on it, and crop all the ' +
+                         'images in parallel without showing any windows. Works best on maps with a clear, regular ' +
+                         'grid, check the sizes in the output filenames')
+parser.add_argument('-j', '--jobs', type=int,
+                    help='auto mode only - number of images to process in parallel, default is the number of CPUs',
+                    default=os.cpu_count() or 1)
+
+
+def auto_crop(input_file, output_path):
+    """
+    Find the grid and crop a single image, returning an error message rather than raising so one image which can't be
+    read or has no grid doesn't stop the rest. Runs in a worker process, so arguments must be picklable.
+    """
+    try:
+        ImageGrid.auto_crop(input_file, output_path)
+        return None
+    except Exception as e:
+        return f'{input_file.name}: {e}'
 
 
 def main():
     options = parser.parse_args()
-    input_dir = abspath(options.input_dir)
-    if options.output_dir is None:
-        output_dir = input_dir
-    else:
-        output_dir = abspath(options.output_dir)
     # Check and build input and output directories as needed
-    if not ensure_dir(input_dir, create=False):
-        exit(1)
-    if not ensure_dir(output_dir):
+    dirs = input_and_output_dirs(options.input_dir, options.output_dir)
+    if dirs is None:
         exit(1)
+    input_dir, output_dir = dirs
 
     input_path = Path(input_dir)
     output_path = Path(output_dir)
-    for input_file in input_path.iterdir():
-        ImageGrid.show_and_crop(input_file, output_path)
+    if options.auto:
+        input_files = [input_file for input_file in input_path.iterdir() if input_file.is_file()]
+        with ProcessPoolExecutor(max_workers=max(1, min(options.jobs, len(input_files)))) as executor:
+            for error in executor.map(auto_crop, input_files, [output_path] * len(input_files)):
+                if error is not None:
+                    logging.error(f'Unable to crop {error}')
+    else:
+        for input_file in input_path.iterdir():
+            ImageGrid.show_and_crop(input_file, output_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -298,8 +298,11 @@ class ImageSplitter:
         self.upsampler = nn.Upsample(scale_factor=scale_factor, mode='bilinear')
 
     def split_img_tensor(self, pil_img, scale_method=Image.BILINEAR, img_pad=0):
-        # resize image and convert them into tensor
-        img_tensor = to_tensor(pil_img).unsqueeze(0)
+        # resize image and convert them into tensor, unless we've been handed a tensor already
+        if isinstance(pil_img, torch.Tensor):
+            img_tensor = pil_img
+        else:
+            img_tensor = to_tensor(pil_img).unsqueeze(0)
         img_tensor = nn.ReplicationPad2d(self.pad_size)(img_tensor)
         batch, channel, height, width = img_tensor.size()
         self.height = height
@@ -337,7 +340,9 @@ class ImageSplitter:
         return patch_box
 
     def merge_img_tensor(self, list_img_tensor):
-        out = torch.zeros((1, 3, self.height * self.scale_factor, self.width * self.scale_factor))
+        # Build the output on the same device as the patches so results can stay on the GPU
+        out = torch.zeros((1, 3, self.height * self.scale_factor, self.width * self.scale_factor),
+                          device=list_img_tensor[0].device)
         img_tensors = copy.copy(list_img_tensor)
         rem = self.pad_size * 2
 
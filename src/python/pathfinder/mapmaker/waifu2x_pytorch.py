@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 from PIL import Image
-from torchvision.utils import make_grid
+from torchvision.transforms.functional import to_tensor
 import logging
 from pathfinder.mapmaker.pytorch import CARN_V2, network_to_half, ImageSplitter
 import importlib.resources as resources
@@ -16,21 +16,28 @@ class Waifu2x:
     """
 
     @staticmethod
-    def tensor_to_image(tensor, nrow=8, padding=2, normalize=False, range=None,
-                        scale_each=False, pad_value=0):
+    def tensor_to_image(tensor):
         """
-        Get a PIL Image from the supplied tensor
+        Get a PIL Image from the supplied single image tensor, of shape (1, C, H, W) or (C, H, W)
         """
-        grid = make_grid(tensor, nrow=nrow, padding=padding, pad_value=pad_value,
-                         normalize=normalize, range=range, scale_each=scale_each)
+        if tensor.dim() == 4:
+            tensor = tensor.squeeze(0)
         # Add 0.5 after unnormalizing to [0, 255] to round to nearest integer
-        ndarr = grid.mul(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).to('cpu', torch.uint8).numpy()
+        ndarr = tensor.mul(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).to('cpu', torch.uint8).numpy()
         return Image.fromarray(ndarr)
 
-    def __init__(self):
+    def __init__(self, batch_size=None, threads=None):
         """
         Create the model and load in the checkpoint file. Attempts to check whether CUDA
         is available, using the CPU if not
+
+        :param batch_size:
+            Maximum number of image patches to run through the model at once. Defaults to 16 when using CUDA, where
+            batching keeps the GPU busy, and 1 on the CPU where it makes no difference
+        :param threads:
+            Number of threads torch should use when running on the CPU. Defaults to None to leave torch's own default,
+            which is one per core - set this lower when running several scalers in parallel processes, otherwise they
+            all compete for every core
         """
         LOGGER.info('Creating image scaler')
         checkpoint = resources.open_binary('pathfinder.mapmaker.pytorch',
@@ -53,20 +60,58 @@ class Waifu2x:
         else:
             LOGGER.info('CUDA not available, using CPU for scaling')
             self.model = self.model.float()
+            if threads:
+                torch.set_num_threads(threads)
+        # Only ever used for inference
+        self.model.eval()
+        self.batch_size = batch_size or (16 if self.cuda else 1)
         # Create an image splitter, use this to process the source image in tiles
         self.img_splitter = ImageSplitter(seg_size=64, scale_factor=2, boarder_pad_size=3)
 
-    def scale(self, image: Image) -> Image:
+    def scale(self, image: Image, passes=1) -> Image:
         """
-        Run a single scaling pass on the supplied image object, returning a scaled image
+        Run one or more 2x scaling passes on the supplied image object, returning a scaled image. The image is only
+        converted to a tensor once on the way in and once on the way out, intermediate results are passed directly
+        from one pass to the next.
+
+        :param image:
+            Image to scale
+        :param passes:
+            Number of passes to run, the result will be 2^passes times the size of the input
+        :return:
+            The scaled image
         """
-        img_patches = self.img_splitter.split_img_tensor(image.convert('RGB'),
+        img_tensor = to_tensor(image.convert('RGB')).unsqueeze(0)
+        if self.cuda:
+            # Copy the whole image to the GPU once, it then stays there until all passes are complete
+            img_tensor = img_tensor.cuda()
+        for _ in range(passes):
+            img_tensor = self.scale_tensor(img_tensor).clamp_(0, 1)
+        return Waifu2x.tensor_to_image(img_tensor)
+
+    def scale_tensor(self, img_tensor):
+        """
+        Run a single scaling pass on an image tensor of shape (1, 3, H, W) with values in the range 0-1, returning a
+        tensor of shape (1, 3, 2H, 2W) on the same device as the model
+        """
+        if self.cuda:
+            img_tensor = img_tensor.cuda()
+        img_patches = self.img_splitter.split_img_tensor(img_tensor,
                                                          scale_method=None,
                                                          img_pad=0)
-        with torch.no_grad():
-            if self.cuda:
-                out = [self.model(i.cuda()) for i in img_patches]
-            else:
-                out = [self.model(i) for i in img_patches]
-        img_upscale = self.img_splitter.merge_img_tensor(out)
-        return Waifu2x.tensor_to_image(img_upscale)
+        # Group together patches of the same shape, which is all of them other than those at the right and bottom
+        # edges, and run them through the model in batches rather than one at a time
+        patches_by_shape = {}
+        for index, patch in enumerate(img_patches):
+            patches_by_shape.setdefault(patch.shape, []).append(index)
+        out = [None] * len(img_patches)
+        # inference_mode skips autograd's version counting as well as gradient tracking, fall back to no_grad for
+        # versions of torch older than 1.9 which don't have it
+        with getattr(torch, 'inference_mode', torch.no_grad)():
+            for indices in patches_by_shape.values():
+                for start in range(0, len(indices), self.batch_size):
+                    batch = indices[start:start + self.batch_size]
+                    results = self.model(torch.cat([img_patches[i] for i in batch]))
+                    for i, result in zip(batch, results.split(1)):
+                        out[i] = result
+        return self.img_splitter.merge_img_tensor(out)
@@ -1,19 +1,29 @@
+import copy
 import csv
+import hashlib
+import logging
+import pickle
 import re
 import textwrap
 from dataclasses import dataclass, field
-from os.path import isfile
+from os import stat
+from os.path import abspath, join
 from typing import List, Optional
 from urllib.request import urlretrieve
 
 import requests
 from pydotplus.graphviz import Node, Edge, Dot
 
+from pathfinder.utils import Config, FileCache
+
 DEFAULT_FEAT_URL = \
     'https://docs.google.com/spreadsheets/d/1XqQO21AyE2WtLwW0wSjA9ov74A9tmJmVJjrhPK54JHQ/export?format=csv'
 
 CACHE_FILE_NAME = 'pathfinder_feats.csv'
 
+# Version of the pickled feats in the cache, bump this when Feat or FeatDict change so old entries aren't used
+_PICKLE_VERSION = 1
+
 
 def read_feat_csv(csv_url: str = DEFAULT_FEAT_URL, cache_feats=True) -> 'FeatDict':
     """
@@ -199,32 +209,61 @@ def read_feat_csv(csv_url: str = DEFAULT_FEAT_URL, cache_feats=True) -> 'FeatDic
         reader = csv.reader(response.content.decode('utf-8').splitlines(), delimiter=',')
         return build_feat_dict(reader)
     else:
-        if not isfile(CACHE_FILE_NAME):
+        # One stat call both checks the CSV has been downloaded and gets the modification time for the pickle name
+        try:
+            csv_mtime = stat(CACHE_FILE_NAME).st_mtime_ns
+        except FileNotFoundError:
             urlretrieve(csv_url, CACHE_FILE_NAME)
-        with open(CACHE_FILE_NAME) as file:
-            return build_feat_dict(csv.reader(file, delimiter=','))
+            csv_mtime = stat(CACHE_FILE_NAME).st_mtime_ns
+        # Parsing the CSV and building the dependency graph is the slow part, so keep a pickled copy of the result in
+        # the user's own cache directory, keyed on the CSV path and modification time so it's rebuilt when the CSV
+        # changes, and on a format version to bump if the Feat classes change shape
+        cache = FileCache(join(Config().dir, 'cache', 'pyfeats'), max_size_mb=64)
+        csv_path = abspath(CACHE_FILE_NAME)
+        key = hashlib.blake2b(f'{csv_path}:{csv_mtime}'.encode('utf-8'), digest_size=16).hexdigest()
+        key = f'feats_v{_PICKLE_VERSION}_{key}.pkl'
+        cached = cache.get(key)
+        if cached is not None:
+            try:
+                with open(cached, 'rb') as file:
+                    return pickle.load(file)
+            except Exception:
+                logging.warning(f'Unable to read cached feats from {cached}, parsing the CSV again')
+        with open(csv_path) as file:
+            feats = build_feat_dict(csv.reader(file, delimiter=','))
+
+        def write(filename):
+            with open(filename, 'wb') as f:
+                pickle.dump(feats, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        cache.put(key, write)
+        return feats
 
 
 def traverse(selected_feats: ['Feat'], traverse_parents=False, traverse_children=False) -> ['Feat']:
-    # Traverse the entire graph, finding all nodes attached to any nodes in the selected_feats input nodes
+    # Traverse the entire graph, finding all nodes attached to any nodes in the selected_feats input nodes. Nodes seen
+    # so far are tracked by identity in a set, testing membership of a list would compare Feats field by field.
     found_nodes = []
+    seen = set(id(feat) for feat in selected_feats)
 
     def adjacent(edge_nodes):
         new_edges = []
         for node in edge_nodes:
             if traverse_parents:
                 for parent in node.parents:
-                    if parent not in new_edges and parent not in found_nodes and parent not in edge_nodes:
+                    if id(parent) not in seen:
+                        seen.add(id(parent))
                         new_edges.append(parent)
             if traverse_children:
                 for child in node.children:
-                    if child not in new_edges and child not in found_nodes and child not in edge_nodes:
+                    if id(child) not in seen:
+                        seen.add(id(child))
                         new_edges.append(child)
         return new_edges
 
     while True:
         new_feats = adjacent(selected_feats)
-        found_nodes = found_nodes + selected_feats
+        found_nodes.extend(selected_feats)
         selected_feats = new_feats
         if not new_feats:
             break
@@ -391,6 +430,33 @@ class FeatDict(dict):
         super(FeatDict, self).__init__(internal_dict)
         self.root_feats = []
 
+    def __reduce__(self):
+        # Feats refer to each other through their parents and children lists, which pickle would follow recursively,
+        # easily exceeding the recursion limit for a graph of this size. Store the links as indices into a flat list.
+        feats = []
+        index = {}
+
+        def add(feat):
+            if id(feat) not in index:
+                index[id(feat)] = len(feats)
+                feats.append(feat)
+
+        for feat in self.values():
+            add(feat)
+        i = 0
+        while i < len(feats):
+            for linked_feat in feats[i].parents + feats[i].children:
+                add(linked_feat)
+            i += 1
+        links = [([index[id(parent)] for parent in feat.parents], [index[id(child)] for child in feat.children])
+                 for feat in feats]
+        unlinked_feats = [copy.copy(feat) for feat in feats]
+        for feat in unlinked_feats:
+            feat.parents = []
+            feat.children = []
+        return _unpickle_feat_dict, (unlinked_feats, links, {key: index[id(feat)] for key, feat in self.items()},
+                                     [index[id(feat)] for feat in self.root_feats])
+
     def find(self, regex: str) -> ['Feat']:
         pattern = re.compile(regex.lower().strip())
         return list(self[key] for key in self if pattern.match(key))
@@ -513,6 +579,16 @@ NODE_LABEL_NO_PRE = """<
 >"""
 
 
+def _unpickle_feat_dict(feats, links, keys, root_feats) -> FeatDict:
+    # Rebuild a FeatDict from the flattened form produced by FeatDict.__reduce__
+    for feat, (parents, children) in zip(feats, links):
+        feat.parents = [feats[i] for i in parents]
+        feat.children = [feats[i] for i in children]
+    feat_dict = FeatDict((key, feats[i]) for key, i in keys.items())
+    feat_dict.root_feats = [feats[i] for i in root_feats]
+    return feat_dict
+
+
 @dataclass
 class Feat:
     """Class to represent a single feat"""
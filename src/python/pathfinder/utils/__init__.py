@@ -1,4 +1,5 @@
 import os
+import tempfile
 from os.path import abspath
 import logging
 from pathlib import Path
@@ -32,6 +33,22 @@ def ensure_dir(path, create=True):
         return True
 
 
+def input_and_output_dirs(input_dir, output_dir=None):
+    """
+    Resolve the input and output directories passed to a command line tool. The input directory must already exist, the
+    output directory defaults to the input directory if not specified and is created if needed.
+
+    :param input_dir: input directory
+    :param output_dir: output directory, or None to use the input directory
+    :return: a tuple of absolute (input_dir, output_dir) paths, or None if either can't be used
+    """
+    input_dir = abspath(input_dir)
+    output_dir = input_dir if output_dir is None else abspath(output_dir)
+    if not ensure_dir(input_dir, create=False) or not ensure_dir(output_dir):
+        return None
+    return input_dir, output_dir
+
+
 class Config:
     """
     Simple YAML based configuration
@@ -82,3 +99,82 @@ class Config:
             return _item
         except:
             raise AttributeError(f'No key \'{path}\' found in utils!')
+
+
+class FileCache:
+    """
+    Simple size bounded on-disk cache. Each entry is a single file in the cache directory, named from its key. When the
+    total size of the cache exceeds the limit the least recently used entries are deleted, where 'used' is tracked
+    through the file modification time.
+    """
+
+    def __init__(self, path, max_size_mb=2048):
+        """
+        Create a FileCache, creating the cache directory if it doesn't already exist
+
+        :param path: directory to hold cached files
+        :param max_size_mb: maximum total size of the cache in megabytes
+        """
+        self.path = Path(path)
+        self.max_size = max_size_mb * 1024 * 1024
+        os.makedirs(self.path, exist_ok=True)
+
+    def get(self, key: str):
+        """
+        Look up a key in the cache
+
+        :param key: key to look for
+        :return: the Path of the cached file if present, otherwise None
+        """
+        path = self.path / key
+        try:
+            # Mark as recently used
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, write):
+        """
+        Add an entry to the cache. The file is written to a temporary location and then moved into place, so readers
+        will never see a partially written entry.
+
+        :param key: key for the new entry
+        :param write: function which will be called with a filename to write the content for this entry
+        :return: the Path of the cached file
+        """
+        path = self.path / key
+        fd, temp_name = tempfile.mkstemp(dir=self.path, prefix='.tmp-', suffix=path.suffix)
+        os.close(fd)
+        try:
+            write(temp_name)
+            os.replace(temp_name, path)
+        except BaseException:
+            os.remove(temp_name)
+            raise
+        self.evict()
+        return path
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache is within its size limit
+        """
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.startswith('.tmp-'):
+                try:
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                except FileNotFoundError:
+                    # Removed by another process while we were looking
+                    pass
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            logging.info(f'Evicting {path} from cache')
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
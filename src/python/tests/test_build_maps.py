@@ -0,0 +1,59 @@
+import tempfile
+import unittest
+from os.path import join
+
+from PIL import Image
+
+from pathfinder.mapmaker import build_maps
+
+
+class RunWaifu2xTest(unittest.TestCase):
+
+    def test_image_already_at_target_size_outlives_source(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = join(temp_dir, 'test_3x2.png')
+            Image.new('RGB', (360, 240), (10, 20, 30)).save(filename)
+            with Image.open(filename) as source:
+                image = build_maps.run_waifu2x(source, 3, 2, 120)
+            # The source has been closed, the result must still be usable
+            self.assertEqual(image.size, (360, 240))
+            self.assertEqual(image.getpixel((0, 0)), (10, 20, 30))
+
+    def test_process_entry_with_image_at_target_size(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = join(temp_dir, 'test_3x2.png')
+            Image.new('RGB', (360, 240), (10, 20, 30)).save(filename)
+            for mode in ('PNG', 'SINGLE', 'TILED'):
+                result = build_maps.process_entry(filename, temp_dir, mode=mode, paper_size=build_maps.mapmaker.Paper.A4,
+                                                  page_border=5, saturation=1.0, sharpen=1.1, brighten=1.2, overlap=3,
+                                                  gridsize=120)
+                self.assertEqual(result.status, 'built', f'{mode}: {result.error}')
+
+
+class ProcessEntryPresetsTest(unittest.TestCase):
+
+    def test_upscales_once_for_several_modes(self):
+        calls = []
+        run_waifu2x = build_maps.run_waifu2x
+
+        def counting_run_waifu2x(*args):
+            calls.append(args[1:])
+            return run_waifu2x(*args)
+
+        build_maps.run_waifu2x = counting_run_waifu2x
+        try:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                filename = join(temp_dir, 'test_3x2.png')
+                Image.new('RGB', (360, 240), (10, 20, 30)).save(filename)
+                settings = dict(paper_size=build_maps.mapmaker.Paper.A4, page_border=5, saturation=1.0, sharpen=1.1,
+                                brighten=1.2, overlap=3, gridsize=120)
+                results = build_maps.process_entry_presets(
+                    filename, [(mode, dict(settings, mode=mode)) for mode in ('PNG', 'SINGLE', 'TILED')], temp_dir)
+        finally:
+            build_maps.run_waifu2x = run_waifu2x
+        self.assertEqual([result.status for _, result in results], ['built'] * 3)
+        self.assertEqual(len(calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
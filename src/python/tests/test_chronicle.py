@@ -0,0 +1,63 @@
+import io
+import unittest
+from unittest import mock
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.pdf import PageObject
+from urllib3.response import HTTPResponse
+
+from pathfinder import chronicle
+from pathfinder.chronicle.pdf import TransparentPDF
+
+
+class ParseReportingSheetTest(unittest.TestCase):
+
+    def test_crlf_line_endings(self):
+        row = 'Player {0},1234{0},{0},Character {0},Dark Archive,FALSE,1,10,2,4,30,,2020-01-01,Event,1,5678'
+        lines = ['Player,PFS,Character,Name,Faction,Slow,Tier,Roll,Prestige,XP,Gold,Notes,Date,Event,Code,GM'] + \
+                [row.format(i) for i in range(3000)]
+        body = ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+        response = mock.MagicMock()
+        response.__enter__.return_value = response
+        response.raw = HTTPResponse(body=io.BytesIO(body), preload_content=False)
+        with mock.patch.object(chronicle.requests, 'get', return_value=response):
+            players = list(chronicle.parse_reporting_sheet('http://example.com/sheet.csv'))
+        self.assertEqual(len(players), 3000)
+        self.assertEqual(players[-1].player_name, 'Player 2999')
+        self.assertEqual(players[-1].gm_number, '5678')
+
+
+class StampPageTest(unittest.TestCase):
+
+    def test_blank_page_without_contents(self):
+        pdf = TransparentPDF(orientation='P', unit='pt', format=(100, 100))
+        pdf.add_page()
+        pdf.set_fill_color(255, 0, 0)
+        pdf.rect(10, 10, 20, 20, style='F')
+        overlay = PdfFileReader(io.BytesIO(pdf.output(dest='S').encode('latin-1'))).getPage(0)
+        page = PageObject.createBlankPage(None, 100, 100)
+        self.assertNotIn('/Contents', page)
+        chronicle._stamp_page(page, overlay)
+        writer = PdfFileWriter()
+        writer.addPage(page)
+        out = io.BytesIO()
+        writer.write(out)
+        stamped = PdfFileReader(io.BytesIO(out.getvalue())).getPage(0)
+        self.assertIn('/PFToolsOverlay', stamped['/Resources']['/XObject'])
+
+
+class StringWidthTest(unittest.TestCase):
+
+    def test_width_in_each_pdfs_units(self):
+        widths = {}
+        for unit in ('pt', 'mm'):
+            pdf = TransparentPDF(orientation='P', unit=unit, format='A4')
+            pdf.add_page()
+            pdf.set_font('Helvetica', size=10)
+            widths[unit] = chronicle._string_width(pdf, 'Some text')
+            self.assertAlmostEqual(widths[unit], pdf.get_string_width('Some text'))
+        self.assertNotAlmostEqual(widths['pt'], widths['mm'])
+
+
+if __name__ == '__main__':
+    unittest.main()
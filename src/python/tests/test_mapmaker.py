@@ -0,0 +1,94 @@
+import struct
+import tempfile
+import unittest
+import zlib
+from os.path import join
+
+from PIL import Image
+from fpdf import FPDF
+
+from pathfinder import mapmaker
+from pathfinder.mapmaker import MapPDF
+
+
+def _chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def _write_png(filename, width, height, bit_depth, colour_type, row):
+    # Build the PNG by hand, Pillow can't write every bit depth
+    ihdr = struct.pack('>IIBBBBB', width, height, bit_depth, colour_type, 0, 0, 0)
+    raw = b''.join(b'\x00' + row for _ in range(height))
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + _chunk(b'IHDR', ihdr) + _chunk(b'IDAT', zlib.compress(raw)) +
+                _chunk(b'IEND', b''))
+
+
+class ParsePngTest(unittest.TestCase):
+
+    def test_eight_bit_rgb(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = join(temp_dir, 'rgb8.png')
+            Image.new('RGB', (4, 2), (1, 2, 3)).save(filename)
+            info = MapPDF()._parsepng(filename)
+            self.assertEqual(info['bpc'], 8)
+            self.assertEqual(len(zlib.decompress(info['data'])), 2 * (1 + 4 * 3))
+
+    def test_sixteen_bit_rgb_rejected(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = join(temp_dir, 'rgb16.png')
+            _write_png(filename, 4, 2, 16, 2, b'\x01\x02' * 12)
+            # Goes to FPDF's parser, which doesn't support 16 bit, rather than being embedded as 8 bit
+            with self.assertRaises(RuntimeError):
+                MapPDF()._parsepng(filename)
+
+    def test_four_bit_grey_left_to_fpdf(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = join(temp_dir, 'grey4.png')
+            _write_png(filename, 4, 2, 4, 0, b'\x12\x34')
+            info = MapPDF()._parsepng(filename)
+            expected = FPDF()._parsepng(filename)
+            self.assertEqual(info['bpc'], 4)
+            self.assertEqual(info['dp'], expected['dp'])
+            self.assertEqual(info['data'], expected['data'])
+            # Each row is a filter byte and 4 pixels at 4 bits, matching what the image dictionary declares
+            self.assertEqual(len(zlib.decompress(info['data'])), 2 * (1 + 2))
+
+
+class ExtractImagesTest(unittest.TestCase):
+
+    def test_image_on_several_pages_only_decoded_once(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            image_filename = join(temp_dir, 'map.jpg')
+            Image.new('RGB', (200, 150), (40, 80, 120)).save(image_filename)
+            pdf_filename = join(temp_dir, 'maps.pdf')
+            pdf = MapPDF(unit='mm', format='A4')
+            for _ in range(3):
+                pdf.add_page()
+                pdf.image(image_filename, 10, 10, 100, 75)
+            pdf.output(pdf_filename)
+
+            skip_ids = mapmaker.skip_ids_by_page(mapmaker.open_pdf(pdf_filename), range(3))
+            self.assertEqual(len(skip_ids[0]), 0)
+            self.assertEqual(len(skip_ids[1]), 1)
+            self.assertEqual(skip_ids[1], skip_ids[2])
+
+            decoded = []
+            image_from_vobj = mapmaker._image_from_vobj
+
+            def counting_image_from_vobj(vobj, **kwargs):
+                decoded.append(vobj)
+                return image_from_vobj(vobj, **kwargs)
+
+            mapmaker._image_from_vobj = counting_image_from_vobj
+            try:
+                pages = [mapmaker.extract_png_images_from_pdf_page(pdf_filename, page_number, skip_ids=skip)
+                         for page_number, skip in enumerate(skip_ids)]
+            finally:
+                mapmaker._image_from_vobj = image_from_vobj
+            self.assertEqual([len(page_images) for page_images in pages], [1, 0, 0])
+            self.assertEqual(len(decoded), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()